@@ -1,18 +1,133 @@
 import argparse
+import multiprocessing
+import os
+import sys
+import time
+import msmbuilder.Conformation
 import msmbuilder.Trajectory
+import msmbuilder.Serializer
 
-def convertXtc2lh5(xtcfile,  ref_conf, outFilename):
-    ''' Convert the xtc-files to a .lh5 file '''
+def convertXtc2lh5(xtcfile,  ref_conf, outFilename, sidecar=False, codec="zlib", level=9, layout=None, select="all", chunk=1000):
+    ''' Convert the xtc-files to a .lh5 file compressed with the given codec and level and chunked for the given access layout, optionally with an uncompressed coordinate sidecar.
+        Frames are streamed chunk frames at a time, and only the atoms of the selection (all, heavy, backbone or nosolvent) are written. '''
 
-    Traj = msmbuilder.Trajectory.Trajectory.LoadFromXTC([xtcfile], PDBFilename=ref_conf)
-    Traj.Save("%s"%outFilename)
+    if sidecar and not outFilename.endswith(".lh5"):
+        raise ValueError("a coordinate sidecar can only be written for .lh5 output, not %s" % outFilename)
+    Conf = msmbuilder.Conformation.Conformation.LoadFromPDB(ref_conf)
+    AtomIndices = None
+    if select != "all":
+        AtomIndices = Conf.GetAtomSelection(select)
+    Filters = msmbuilder.Serializer.GetFilters(codec, level)
+    if outFilename.endswith(".lh5"):
+        msmbuilder.Trajectory.Trajectory.ConvertXTCToLHDF([xtcfile], outFilename, Conf=Conf, AtomIndices=AtomIndices, ChunkSize=chunk, Filters=Filters, ChunkShape=layout)
+    else:
+        Traj = msmbuilder.Trajectory.Trajectory.LoadFromXTC([xtcfile], Conf=Conf)
+        if AtomIndices is not None:
+            Traj.RestrictAtomIndices(AtomIndices)
+        Traj.Save("%s"%outFilename, Filters=Filters, ChunkShape=layout)
+    if sidecar:
+        msmbuilder.Trajectory.WriteCoordinateSidecar(outFilename)
+
+def isUpToDate(xtcfile, ref_conf, outFilename):
+    ''' True if outFilename exists and is newer than both its inputs '''
+
+    if not os.path.exists(outFilename):
+        return False
+    return os.path.getmtime(outFilename) >= max(os.path.getmtime(xtcfile), os.path.getmtime(ref_conf))
+
+def convertJob(job):
+    ''' Convert one trajectory in a worker process; returns (xtcfile, outFilename, seconds, frames, error) '''
+
+    xtcfile, ref_conf, outFilename, options = job
+    start = time.time()
+    try:
+        if os.path.exists(outFilename):
+            os.remove(outFilename)
+        convertXtc2lh5(xtcfile, ref_conf, outFilename, **options)
+        frames = None
+        if outFilename.endswith("h5"):
+            frames = msmbuilder.Trajectory.Trajectory.LoadTrajectoryFile(outFilename, JustInspect=True)[0]
+    except Exception as e:
+        return xtcfile, outFilename, time.time() - start, None, "%s: %s" % (e.__class__.__name__, e)
+    return xtcfile, outFilename, time.time() - start, frames, None
+
+def convertBatch(xtcfiles, ref_confs, outFilenames, procs=None, force=False, **options):
+    ''' Convert many trajectories in a pool of procs worker processes, skipping outputs that are up to date.
+        Prints the time and throughput of every file; returns the number of failed conversions. '''
+
+    jobs = []
+    for xtcfile, ref_conf, outFilename in zip(xtcfiles, ref_confs, outFilenames):
+        if not force and isUpToDate(xtcfile, ref_conf, outFilename):
+            print "%s is up to date, skipping" % outFilename
+        else:
+            jobs.append((xtcfile, ref_conf, outFilename, options))
+    if len(jobs) == 0:
+        return 0
+    if procs is None:
+        procs = multiprocessing.cpu_count()
+    procs = max(min(procs, len(jobs)), 1)
+
+    start = time.time()
+    if procs > 1:
+        pool = multiprocessing.Pool(procs)
+        results = pool.imap_unordered(convertJob, jobs)
+    else:
+        pool = None
+        results = (convertJob(job) for job in jobs)
+    failed = 0
+    totalBytes = 0
+    totalFrames = 0
+    for xtcfile, outFilename, seconds, frames, error in results:
+        if error is not None:
+            failed += 1
+            print "%s -> %s FAILED after %.1f s: %s" % (xtcfile, outFilename, seconds, error)
+            continue
+        nbytes = os.path.getsize(xtcfile)
+        totalBytes += nbytes
+        rate = "%.1f MB/s" % (nbytes / 1e6 / max(seconds, 1e-6))
+        if frames is not None:
+            totalFrames += frames
+            rate = "%d frames, %.0f frames/s, %s" % (frames, frames / max(seconds, 1e-6), rate)
+        print "%s -> %s: %.1f s (%s)" % (xtcfile, outFilename, seconds, rate)
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print "Converted %d of %d files with %d processes in %.1f s (%d frames, %.1f MB/s)" % (len(jobs) - failed, len(jobs), procs, elapsed, totalFrames, totalBytes / 1e6 / max(elapsed, 1e-6))
+    return failed
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--inp", help="input filename")
-    parser.add_argument("--out", help="output filename")
-    parser.add_argument("--ref", help="reference filename")
+    parser.add_argument("--inp", nargs="+", required=True, help="input filename(s)")
+    parser.add_argument("--out", nargs="+", help="output filename(s), one per input")
+    parser.add_argument("--outdir", help="write <outdir>/<input name>.lh5 instead of giving --out")
+    parser.add_argument("--ref", nargs="+", required=True, help="reference filename, or one per input")
+    parser.add_argument("--procs", default=None, type=int, help="number of conversions run at the same time (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="convert even if the output is newer than its inputs")
+    parser.add_argument("--sidecar", action="store_true", help="also write an uncompressed float32 coordinate file (<out>.npy) for fast repeated reads; .lh5 outputs only")
+    parser.add_argument("--codec", default="zlib", choices=sorted(msmbuilder.Serializer.COMPRESSION_CODECS), help="HDF5 compression codec (default: zlib)")
+    parser.add_argument("--level", default=9, type=int, help="compression level, 0-9 (default: 9)")
+    parser.add_argument("--layout", default=None, choices=["frame", "atom"], help="chunk layout: frame for whole-frame reads, atom for atom-subset reads (default: chosen by PyTables)")
+    parser.add_argument("--select", default="all", choices=["all", "heavy", "backbone", "nosolvent"], help="atoms to keep in the output (default: all)")
+    parser.add_argument("--chunk", default=1000, type=int, help="number of frames converted at a time (default: 1000)")
     args = parser.parse_args()
 
-    convertXtc2lh5(args.inp, args.ref, args.out)
\ No newline at end of file
+    if args.outdir is not None:
+        outs = [os.path.join(args.outdir, os.path.splitext(os.path.basename(f))[0] + ".lh5") for f in args.inp]
+    else:
+        outs = args.out
+    if outs is None or len(outs) != len(args.inp):
+        parser.error("give one --out per --inp, or --outdir")
+    if args.sidecar and [f for f in outs if not f.endswith(".lh5")]:
+        parser.error("--sidecar is only supported for .lh5 outputs")
+    refs = args.ref
+    if len(refs) == 1:
+        refs = refs * len(args.inp)
+    elif len(refs) != len(args.inp):
+        parser.error("give one --ref, or one per --inp")
+
+    failed = convertBatch(args.inp, refs, outs, procs=args.procs, force=args.force, sidecar=args.sidecar, codec=args.codec,
+                          level=args.level, layout=args.layout, select=args.select, chunk=args.chunk)
+    sys.exit(1 if failed else 0)
@@ -161,9 +161,12 @@ class MSMProject(object):
 
         # Create the msm project from the reference conformation
         #TODO IMAN provide weighting here
-        Proj = CreateCopernicusProject(self.ref_conf, self.filelist)
-        self.Proj = Proj
+        # Register this round's new trajectories and load the project from the registry
         C1   = Conformation.Conformation.LoadFromPDB(self.ref_conf)
+        RegistryF = os.path.join('Data','ProjectRegistry.h5')
+        RegisterTrajectories(RegistryF, [f for TrajPartList in self.filelist for f in TrajPartList], Conf=C1)
+        Proj = LoadCopernicusProject(self.ref_conf, RegistryF)
+        self.Proj = Proj
         
         # Automate the clustering to only CA or backbone atoms
         # TODO: fix this
@@ -187,10 +190,10 @@ class MSMProject(object):
         Generators.SaveToHDF(GenF)
         if os.path.exists(AssF):
             os.remove(AssF)
-        msmbuilder.Serializer.SaveData(AssF,Assignments)
+        msmbuilder.Serializer.SaveData(AssF,Assignments,ChunkShape="frame")
         if os.path.exists(RmsF):
             os.remove(RmsF)
-        msmbuilder.Serializer.SaveData(RmsF,RMSD)
+        msmbuilder.Serializer.SaveData(RmsF,RMSD,ChunkShape="frame")
         
         print "Trim data.\n"
         # Trim data
@@ -240,7 +243,7 @@ class MSMProject(object):
         print "New number of states=%d\n"%NumStates
         if os.path.exists(AssFTrimmed):
             os.remove(AssFTrimmed)
-        msmbuilder.Serializer.SaveData(AssFTrimmed,Assignments)
+        msmbuilder.Serializer.SaveData(AssFTrimmed,Assignments,ChunkShape="frame")
         
         print "Calculating implied time scales..\n"
         # Calculate the implied time-scales
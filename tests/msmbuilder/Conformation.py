@@ -21,6 +21,9 @@
 import numpy as np
 from msmbuilder import PDB, Serializer
 
+BACKBONE_ATOM_NAMES=["N","CA","C","O"]
+SOLVENT_RESIDUE_NAMES=["SOL","WAT","HOH","TIP3","TIP4","TIP5","SPC","T3P","T4P","NA","NA+","CL","CL-","K","K+","MG","ZN"]
+
 class ConformationBaseClass(Serializer.Serializer):
     """Base class for Trajectory and Conformation classes.  Not for separate use."""
     def __init__(self,DictLike=None):
@@ -45,6 +48,30 @@ class ConformationBaseClass(Serializer.Serializer):
         for i in range(self.GetNumberOfAtoms()):
             self["IndexList"][ZeroIndexResidueID[i]].append(i)
 
+    def RestrictAtomIndices(self,AtomIndices):
+        """Keep only the atoms in AtomIndices, updating the atom and residue tables and the coordinates (XYZ and XYZList, if present)."""
+        AtomIndices=np.asarray(AtomIndices)
+        for key in ["ChainID","AtomNames","ResidueNames","AtomID","ResidueID"]:
+            self[key]=self[key][AtomIndices]
+        if "XYZ" in self:
+            self["XYZ"]=self["XYZ"][AtomIndices]
+        if "XYZList" in self and len(self["XYZList"])>0:
+            self["XYZList"]=np.asarray(self["XYZList"])[:,AtomIndices]
+        self.UpdateIndexList()
+
+    def GetAtomSelection(self,Selection):
+        """Return the indices of the atoms in a named selection: "all", "heavy" (no hydrogens), "backbone" (N, CA, C and O) or "nosolvent" (no water or ions, see SOLVENT_RESIDUE_NAMES)."""
+        if Selection=="all":
+            return(np.arange(self.GetNumberOfAtoms()))
+        elif Selection=="heavy":
+            return(np.array([i for i,x in enumerate(self["AtomNames"]) if not x.strip().lstrip("0123456789").startswith("H")],dtype='int'))
+        elif Selection=="backbone":
+            return(np.where(np.in1d(self["AtomNames"],BACKBONE_ATOM_NAMES))[0])
+        elif Selection=="nosolvent":
+            return(np.where(~np.in1d(np.char.strip(self["ResidueNames"]),SOLVENT_RESIDUE_NAMES))[0])
+        else:
+            raise Exception("Unknown atom selection %s; choose all, heavy, backbone or nosolvent"%Selection)
+
     def GetNumberOfAtoms(self):
         """Return the number of atoms in this object."""
         return len(self["AtomNames"])
@@ -1,6 +1,7 @@
 import Conformation
 import os
 import numpy as np
+import tables
 
 from msmbuilder import Conformation, Project, Trajectory
 from msmbuilder.ssaCalculator import ssaCalculator
@@ -13,12 +14,19 @@ class CopernicusProject(Project.Project):
             print "ERROR: no traj number %d" % TrajNumber
             return
 
-        i = 0
-        while i+1 < self["NumTrajs"] and TrajNumber >= self["PartsLenList"][i+1]:
-            i += 1
-        PartNum = TrajNumber - self["PartsLenList"][i]
+        return(self.GetTrajFilenames()[TrajNumber])
+
+    def GetTrajFilenames(self):
+        """Returns a flat list of all trajectory filenames, indexed by trajectory number."""
+        if getattr(self,"_TrajFilenames",None) is None:
+            self._TrajFilenames=[f for TrajPartList in self["FileList"] for f in TrajPartList]
+            self._TrajNumbers=dict((f,i) for i,f in enumerate(self._TrajFilenames))
+        return(self._TrajFilenames)
 
-        return(self["FileList"][i][PartNum])
+    def GetTrajNumber(self,Filename):
+        """Returns the trajectory number of Filename, or None if it is not part of this project."""
+        self.GetTrajFilenames()
+        return(self._TrajNumbers.get(Filename))
 
     def AssignProject(self,Generators,AtomIndices=None,WhichTrajs=None):
         ass, rmsd, w = Project.Project.AssignProject(self, Generators, AtomIndices=AtomIndices, WhichTrajs=WhichTrajs)
@@ -80,7 +88,7 @@ class CopernicusProject(Project.Project):
 
         return startStateList
 
-def CreateCopernicusProject(ConfFilename, FileList):
+def CreateCopernicusProject(ConfFilename, FileList, ManifestFilename=os.path.join("Data","TrajManifest.h5"), NumProcs=None):
     # setup reference conformation
     if ConfFilename == None:
         print "No reference conf! ERROR"
@@ -117,13 +125,95 @@ def CreateCopernicusProject(ConfFilename, FileList):
     except OSError:
         pass
 
-    LenList=[]
-    for i in range(NumTraj):
-        f=P1.GetTrajFilename(i)
-        print f
-        LenList.append(Trajectory.Trajectory.LoadTrajectoryFile(f,Conf=Conf,JustInspect=True)[0])
+    # only trajectories that are new or changed since the last round are inspected
+    Filenames=[P1.GetTrajFilename(i) for i in range(NumTraj)]
+    LenList=Project.InspectTrajectories(Filenames,Conf=Conf,ManifestFilename=ManifestFilename,NumProcs=NumProcs)[0]
 
     P1["TrajLengths"]=np.array(LenList)
 
     return P1
 
+
+
+def OpenProjectRegistry(RegistryFilename):
+    """Open the HDF5 registry of trajectory files for appending, creating it if it does not exist yet.  Trajectory numbers are row numbers in the registry, so they never change once a file is registered."""
+    if os.path.exists(RegistryFilename):
+        return(tables.File(RegistryFilename,'a'))
+    Dir=os.path.dirname(RegistryFilename)
+    if Dir!="" and not os.path.exists(Dir):
+        os.makedirs(Dir)
+    F=tables.File(RegistryFilename,'w')
+    F.createVLArray("/","Filenames",tables.VLStringAtom())
+    F.createEArray("/","TrajLengths",tables.Int64Atom(),(0,))
+    F.createEArray("/","FileSizes",tables.Int64Atom(),(0,))
+    F.createEArray("/","ModTimes",tables.Float64Atom(),(0,))
+    return(F)
+
+def RegisterTrajectories(RegistryFilename, Filenames, Conf=None, NumProcs=None):
+    """Append the trajectory files in Filenames that are not yet in the registry.  Registered files whose size or modification time has changed (e.g. extended trajectories) get their lengths refreshed.  Returns the number of newly registered trajectories."""
+    F=OpenProjectRegistry(RegistryFilename)
+    try:
+        Known=dict((f,i) for i,f in enumerate(F.root.Filenames.read()))
+        Sizes=F.root.FileSizes[:]
+        ModTimes=F.root.ModTimes[:]
+        Changed=[]
+        New=[]
+        for f in Filenames:
+            if f in Known:
+                Stat=os.stat(f)
+                if Stat.st_size!=Sizes[Known[f]] or Stat.st_mtime!=ModTimes[Known[f]]:
+                    Changed.append(f)
+            elif f not in New:
+                New.append(f)
+        ToInspect=Changed+New
+        if len(ToInspect)==0:
+            return(0)
+        LenList=Project.InspectTrajectories(ToInspect,Conf=Conf,NumProcs=NumProcs)[0]
+        for f,Length in zip(ToInspect,LenList):
+            Stat=os.stat(f)
+            if f in Known:
+                i=Known[f]
+                F.root.TrajLengths[i]=Length
+                F.root.FileSizes[i]=Stat.st_size
+                F.root.ModTimes[i]=Stat.st_mtime
+            else:
+                F.root.Filenames.append(f)
+                F.root.TrajLengths.append(np.array([Length],"int64"))
+                F.root.FileSizes.append(np.array([Stat.st_size],"int64"))
+                F.root.ModTimes.append(np.array([Stat.st_mtime],"float64"))
+        F.flush()
+    finally:
+        F.close()
+    print "Registered %d new trajectories" % len(New)
+    return(len(New))
+
+def LoadCopernicusProject(ConfFilename, RegistryFilename):
+    """Build a CopernicusProject from the trajectories recorded in a registry (see RegisterTrajectories)."""
+    if ConfFilename == None:
+        print "No reference conf! ERROR"
+        return
+    F=tables.File(RegistryFilename,'r')
+    try:
+        Filenames=list(F.root.Filenames.read())
+        LenList=F.root.TrajLengths[:]
+    finally:
+        F.close()
+
+    if len(Filenames)==0:
+        print("No data found!  ERROR")
+        return
+
+    S=dict()
+    S["FileList"] = [Filenames]
+    S["NumTrajs"]=len(Filenames)
+    S["PartsLenList"] = np.array([0], "int32")
+    S["TrajFilePath"]=None
+    S["TrajFileBaseName"]=None
+    S["TrajFileType"]=None
+    S["ConfFilename"]=ConfFilename
+    S["TrajLengths"]=np.array(LenList)
+    P1 = CopernicusProject(S)
+    P1["NumTrajs"]=len(Filenames)
+    P1["PartsLenList"] = S["PartsLenList"]
+
+    return P1
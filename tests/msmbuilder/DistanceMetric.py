@@ -22,6 +22,7 @@ Notes:
 Please cite Haque, Beauchamp, Pande 2011 when using this RMSD tool.
 """
 
+import copy
 import numpy as np
 from msmbuilder import rmsdcalc
 
@@ -109,6 +110,12 @@ class TheoData:
         """
         self.XYZData=XYZData
         self.G=G
+
+    def GetSubset(self,Start,Stop):
+        """Return a TheoData holding conformations Start to Stop of self.  The coordinate data is shared, not copied."""
+        Subset=copy.copy(self)
+        Subset.SetData(self.XYZData[Start:Stop],self.G[Start:Stop])
+        return(Subset)
         
 
 class RMSDMetric:
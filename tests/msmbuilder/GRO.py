@@ -0,0 +1,61 @@
+# This file is part of MSMBuilder.
+#
+# Copyright 2011 Stanford University
+#
+# MSMBuilder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Write Gromacs GRO files, formatting one whole frame per string operation.
+"""
+
+import numpy as np
+
+def GetGROFrameTemplate(ATOMNUMS,ATOMS,RESNAMES,RESNUMS):
+    """Build a %-format string that writes the atom lines of one frame, given 3*NumAtoms coordinates in nm."""
+    Lines=[]
+    for i in range(len(ATOMNUMS)):
+        Prefix="%5d%-5s%5s%5d"%(RESNUMS[i]%100000,str(RESNAMES[i])[:5],str(ATOMS[i])[:5],ATOMNUMS[i]%100000)
+        Lines.append(Prefix.replace("%","%%")+"%8.3f%8.3f%8.3f\n")
+    return("".join(Lines))
+
+def FormatGROBox(Box):
+    """Format a box line from a 3x3 matrix of box vectors (as rows) or the 3 lengths of a rectangular box, in nm."""
+    Box=np.asarray(Box,'float64')
+    if Box.shape==(3,):
+        return("%10.5f%10.5f%10.5f\n"%tuple(Box))
+    Diagonal=(Box[0,0],Box[1,1],Box[2,2])
+    OffDiagonal=(Box[0,1],Box[0,2],Box[1,0],Box[1,2],Box[2,0],Box[2,1])
+    if np.any(np.array(OffDiagonal)!=0):
+        return(("%10.5f"*9+"\n")%(Diagonal+OffDiagonal))
+    return("%10.5f%10.5f%10.5f\n"%Diagonal)
+
+def WriteGROConformations(Filename,ATOMNUMS,ATOMS,RESNAMES,RESNUMS,XYZList,Boxes=None,Title="Generated by MSMBuilder"):
+    """Write many conformations (XYZList, in nm) to a multi-frame GRO file.
+
+    Keyword Arguments:
+    Boxes -- Per-frame box vectors, shape (NumFrames,3,3) or (NumFrames,3).  Default: None (a zero box)
+    Title -- The title line of each frame; the frame number is appended.
+    """
+    Template=GetGROFrameTemplate(ATOMNUMS,ATOMS,RESNAMES,RESNUMS)
+    XYZList=np.asarray(XYZList)
+    NumAtoms=XYZList.shape[1]
+    F=open(Filename,'w')
+    for i in range(len(XYZList)):
+        F.write("%s, frame %d\n%5d\n"%(Title,i,NumAtoms))
+        F.write(Template%tuple(XYZList[i].ravel()))
+        if Boxes is None:
+            F.write(FormatGROBox(np.zeros(3)))
+        else:
+            F.write(FormatGROBox(Boxes[i]))
+    F.close()
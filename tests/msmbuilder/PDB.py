@@ -2611,3 +2611,45 @@ def WritePDBConformation(Filename,ATOMNUMS,ATOMS,RESNAMES,RESNUMS,XYZ,CHAIN):
         if ATOMNUMS[i]!=-1:
             F.write(line.tostring()+"\n")
     F.write("ENDMDL\n")
+
+def FormatPDBAtomName(Name):
+    """Pad an atom name to the four PDB name columns, centered the way Molprobity expects."""
+    Name=str(Name)
+    if len(Name)==3:
+        return(Name.rjust(4))
+    elif len(Name)==2:
+        return(" "+Name+" ")
+    elif len(Name)==1:
+        return(" "+Name+"  ")
+    return(Name.center(4)[:4])
+
+def GetPDBFrameTemplate(ATOMNUMS,ATOMS,RESNAMES,RESNUMS,CHAIN):
+    """Build a %-format string that writes one frame of ATOM records, given 3*NumAtoms coordinates in Angstroms.  Atoms with ATOMNUMS -1 are left out, and the returned index array lists the atoms that are written."""
+    Lines=[]
+    Written=[]
+    for i in range(len(ATOMNUMS)):
+        if ATOMNUMS[i]==-1:
+            continue
+        ResName=str(RESNAMES[i])
+        if len(ResName)==3:
+            ResName=ResName+" "
+        Prefix="ATOM  "+str(ATOMNUMS[i]%100000).rjust(5)[:5]+" "+FormatPDBAtomName(ATOMS[i])+" "+ResName.ljust(4)[:4]+str(CHAIN[i]).rjust(1)[:1]+str(RESNUMS[i]).rjust(4)[:4]+"    "
+        Lines.append(Prefix.replace("%","%%")+"%8.3f%8.3f%8.3f"+" "*26+"\n")
+        Written.append(i)
+    return("".join(Lines),np.array(Written,'int'))
+
+def WritePDBConformations(Filename,ATOMNUMS,ATOMS,RESNAMES,RESNUMS,XYZList,CHAIN,Models=False):
+    """Append many conformations (XYZList, in nm) to a PDB, formatting one whole frame per string operation.
+
+    Keyword Arguments:
+    Models -- Wrap each frame in MODEL / ENDMDL records (a standard multi-model PDB).  If False, each frame ends with ENDMDL only, as WritePDBConformation does.  Default: False
+    """
+    Template,Written=GetPDBFrameTemplate(ATOMNUMS,ATOMS,RESNAMES,RESNUMS,CHAIN)
+    XYZList=10*np.asarray(XYZList)[:,Written]
+    F=open(Filename,'a')
+    for i in range(len(XYZList)):
+        if Models==True:
+            F.write("MODEL     %4d\n"%(i+1))
+        F.write(Template%tuple(XYZList[i].ravel()))
+        F.write("ENDMDL\n")
+    F.close()
@@ -20,9 +20,12 @@
 """
 
 import os
+import collections
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 
-from msmbuilder import Conformation, Serializer, Clustering, Trajectory
+from msmbuilder import Conformation, Serializer, Clustering, Trajectory, DistanceMetric
 
 def GetUniqueRandomIntegers(MaxN,NumInt):
     """Get random numbers, with replacement."""
@@ -32,6 +35,72 @@ def GetUniqueRandomIntegers(MaxN,NumInt):
         x=np.concatenate((np.unique(x),x2))
     return(x)
 
+def _EvaluateBlockObservable(Args):
+    """Evaluate a block observable over one trajectory file.  This is a module-level function so that it can be run in worker processes by EvaluateBlockObservableAcrossProject."""
+    TrajFilename,Conf,f,Stride,ResultDim,BlockSize=Args
+    XYZList=Trajectory.Trajectory.LoadTrajectoryFile(TrajFilename,Conf=Conf)["XYZList"][::Stride]
+    if BlockSize==None:
+        BlockSize=max(len(XYZList),1)
+    Values=np.zeros((len(XYZList),)+ResultDim)
+    for i in xrange(0,len(XYZList),BlockSize):
+        Values[i:i+BlockSize]=f(XYZList[i:i+BlockSize])
+    return(Values)
+
+class RMSDObservable:
+    """Block observable giving the RMSD of each conformation to a reference conformation, as in Project.CalcRMSDAcrossProject."""
+    def __init__(self,Conf,Ind0=None,Ind1=None):
+        """Ind0 selects the atoms of the conformations, Ind1 the atoms of Conf.  Default: None (ALL atoms)"""
+        self.Conf=Conf
+        self.Ind0=Ind0
+        self.Ind1=Ind1
+    def __call__(self,XYZList):
+        Ind0=self.Ind0
+        if Ind0 is None:
+            Ind0=np.arange(XYZList.shape[1])
+        Ind1=self.Ind1
+        if Ind1 is None:
+            Ind1=np.arange(len(self.Conf["XYZ"]))
+        #Indexing with an array makes a copy, which the RMSD code may then center in place.
+        return(DistanceMetric.RMSD.GetMultiDistance(XYZList[:,Ind0],self.Conf["XYZ"][Ind1]))
+
+class RadiusOfGyrationObservable:
+    """Block observable giving the radius of gyration of each conformation, with all atoms weighted equally."""
+    def __init__(self,AtomIndices=None):
+        self.AtomIndices=AtomIndices
+    def __call__(self,XYZList):
+        if self.AtomIndices is not None:
+            XYZList=XYZList[:,self.AtomIndices]
+        X=XYZList.astype('float64')
+        X-=X.mean(1)[:,np.newaxis]
+        return(np.sqrt((X**2).sum(2).mean(1)))
+
+def BuildStateIndex(Ass,NumStates=None):
+    """Build a CSR-style index from states to the conformations assigned to them, using a single pass over the assignments.
+
+    Inputs:
+    Ass -- a 2d array of assignments (trajectory, frame), padded with negative ones.
+
+    Keyword Arguments:
+    NumStates -- the number of states to index.  Default: None (uses max(Ass)+1)
+
+    Notes:
+    Returns (IndPtr,Conformations).  Conformations[IndPtr[i]:IndPtr[i+1]] holds the (trajectory, frame) pairs assigned to state i, in the order in which they appear in Ass.
+    """
+    Ass=np.asarray(Ass)
+    NumFrames=Ass.shape[-1]
+    Flat=Ass.reshape(-1)
+    if NumStates==None:
+        NumStates=max(Flat.max()+1,0)
+    Ind=np.where((Flat>=0)&(Flat<NumStates))[0]
+    States=Flat[Ind]
+    IndPtr=np.zeros(NumStates+1,dtype='int')
+    IndPtr[1:]=np.cumsum(np.bincount(States,minlength=NumStates))
+    Ind=Ind[np.argsort(States,kind="mergesort")]
+    Conformations=np.zeros((len(Ind),2),dtype='int')
+    Conformations[:,0]=Ind//NumFrames
+    Conformations[:,1]=Ind%NumFrames
+    return(IndPtr,Conformations)
+
 class Project(Serializer.Serializer):
     """The Project class controls access to a collection of trajectories."""
     
@@ -46,6 +115,10 @@ class Project(Serializer.Serializer):
         for key in ["RunList","CloneList","NumGensList"]:
             if key in S: self[key]=S[key]
         self.Conf=Conformation.Conformation.LoadFromPDB(self["ConfFilename"])
+        self.FilePool=Serializer.HDF5FilePool()
+        self.PrefetchDepth=2
+        self.MaxPrefetchBytes=None
+        self._EmptyTrajectory=None
     def GetNumTrajectories(self):
         """Return the number of trajectories in this project."""
         return(self["TrajLengths"].shape[0])
@@ -57,9 +130,73 @@ class Project(Serializer.Serializer):
         """Return a trajectory object of the ith trajectory."""
         return Trajectory.Trajectory.LoadTrajectoryFile(self.GetTrajFilename(i),Conf=self.Conf)
 
+    def IterTrajectories(self,Which=None,PrefetchDepth=None,MaxPrefetchBytes=None,NumThreads=1):
+        """Yield (TrajNumber,Trajectory) for each trajectory in Which, reading the next trajectories in background threads while the caller works on the current one.
+
+        Keyword Arguments:
+        Which: the trajectories to load, in order.  Default: None (all trajectories)
+        PrefetchDepth: the number of trajectories read ahead of the current one; 0 disables read-ahead.  Default: None (self.PrefetchDepth)
+        MaxPrefetchBytes: an upper bound on the coordinate data held by the trajectories read ahead; a trajectory that does not fit is read when it is reached.  Default: None (self.MaxPrefetchBytes, which is unbounded unless set)
+        NumThreads: the number of reader threads.  Default: 1, since HDF5 serializes reads anyway.
+
+        Notes:
+        Reading and decompression overlap with computation (e.g. RMSD) on the current trajectory, but the caller should not read HDF5 files itself while iterating.
+        """
+        if Which is None:
+            Which=np.arange(self["NumTrajs"])
+        Which=list(Which)
+        if PrefetchDepth==None:
+            PrefetchDepth=self.PrefetchDepth
+        if MaxPrefetchBytes==None:
+            MaxPrefetchBytes=self.MaxPrefetchBytes
+        if PrefetchDepth<=0:
+            for i in Which:
+                yield(i,self.LoadTraj(i))
+            return
+        NumAtoms=self.Conf["XYZ"].shape[0]
+        Sizes=[int(self["TrajLengths"][i])*NumAtoms*3*4 for i in Which]
+        Pool=multiprocessing.pool.ThreadPool(NumThreads)
+        Pending=collections.deque()
+        PendingBytes=0
+        Next=0
+        try:
+            for k in range(len(Which)):
+                if Next==k:
+                    Pending.append(Pool.apply_async(self.LoadTraj,(Which[k],)))
+                    PendingBytes+=Sizes[k]
+                    Next+=1
+                Traj=Pending.popleft().get()
+                PendingBytes-=Sizes[k]
+                while Next<len(Which) and Next-k<=PrefetchDepth and (MaxPrefetchBytes==None or PendingBytes+Sizes[Next]<=MaxPrefetchBytes):
+                    Pending.append(Pool.apply_async(self.LoadTraj,(Which[Next],)))
+                    PendingBytes+=Sizes[Next]
+                    Next+=1
+                yield(Which[k],Traj)
+                del Traj
+        finally:
+            Pool.terminate()
+
     def ReadFrame(self,WhichTraj,WhichFrame):
         """Read a single frame of a single trajectory."""
-        return(Trajectory.Trajectory.ReadFrame(self.GetTrajFilename(WhichTraj),WhichFrame,Conf=self.Conf))
+        return(Trajectory.Trajectory.ReadFrame(self.GetTrajFilename(WhichTraj),WhichFrame,Conf=self.Conf,FilePool=self.FilePool))
+
+    def ReadFrames(self,WhichTraj,WhichFrames):
+        """Read several frames of a single trajectory, in the order given by WhichFrames."""
+        return(Trajectory.Trajectory.ReadFrames(self.GetTrajFilename(WhichTraj),WhichFrames,Conf=self.Conf,FilePool=self.FilePool))
+
+    def WriteCoordinateSidecars(self,Which=None,Precision=1000):
+        """Write an uncompressed float32 coordinate file (see Trajectory.WriteCoordinateSidecar) next to each LHDF trajectory in Which that does not have an up to date one yet.  Later passes over the data then read those files instead of decompressing the LHDF files."""
+        if Which is None:
+            Which=np.arange(self["NumTrajs"])
+        for i in Which:
+            Filename=self.GetTrajFilename(i)
+            if ".lh5" in Filename and Trajectory.LoadCoordinateSidecar(Filename) is None:
+                print("Writing coordinate sidecar for Trajectory %d"%i)
+                Trajectory.WriteCoordinateSidecar(Filename,Precision=Precision)
+
+    def CloseFiles(self):
+        """Close the HDF5 trajectory files that this project keeps open for reading frames."""
+        self.FilePool.Close()
         
     def EvaluateObservableAcrossProject(self,f,Stride=1,ByTraj=False,ResultDim=None):
         """Evaluate an observable function f for every conformation in a dataset.  Assumes that f returns a float.  Also initializes a matrix as negative ones and fills in f(X[i,j]) where X[i,j] is the jth conformation of the ith trajectory.  If ByTraj==True, evalulate f(R1) for each trajectory R1 in the dataset.  This allows you to dramatically speed up certain observable calculations."""
@@ -80,7 +217,7 @@ class Project(Serializer.Serializer):
         for k in Which:
             print(k)
             R1=self.LoadTraj(k)
-            R1["XYZList"][::Stride]
+            R1["XYZList"]=R1["XYZList"][::Stride]
             if ByTraj==False:#Calculate a function of each array of XYZ coordinates
                 for j,Z in enumerate(R1["XYZList"]):
                     value=f(Z)
@@ -90,49 +227,172 @@ class Project(Serializer.Serializer):
                 Ans[l,:len(value)]=value
             l=l+1
         return(Ans)
+
+    def EvaluateBlockObservableAcrossProject(self,f,Stride=1,ResultDim=(),BlockSize=None,NumProcs=1,OutFilename=None,dtype='float32'):
+        """Evaluate an observable f on blocks of conformations, for every trajectory in the dataset.
+
+        Inputs:
+        f: a function that takes an array of conformations (frames, atoms, 3) and returns an array of shape (frames,)+ResultDim.  With NumProcs>1, f is sent to worker processes and must be picklable (e.g. a module-level function).
+
+        Keyword Arguments:
+        Stride: evaluate every Stride-th conformation of each trajectory.
+        ResultDim: the shape of the value of f for a single conformation.  Default: () (a float)
+        BlockSize: the maximum number of conformations passed to f at once.  Default: None (whole trajectories)
+        NumProcs: the number of worker processes used to evaluate trajectories in parallel.
+        OutFilename: if given, the result is a numpy memmap backed by this .npy file.
+        dtype: data type of the result.
+
+        Notes:
+        Returns an array of shape (NumTrajs,N2)+ResultDim padded with negative ones, where N2 is the number of strided frames in the longest trajectory.  Ans[i,j] is f evaluated at frame j*Stride of trajectory i.
+        """
+        ResultDim=tuple(ResultDim)
+        n1=self["NumTrajs"]
+        n2=(max(self["TrajLengths"])+Stride-1)//Stride
+        Shape=(n1,n2)+ResultDim
+        if OutFilename!=None:
+            Ans=np.lib.format.open_memmap(OutFilename,mode='w+',dtype=dtype,shape=Shape)
+        else:
+            Ans=np.empty(Shape,dtype=dtype)
+        Ans[:]=-1
+        Args=[(self.GetTrajFilename(i),self.Conf,f,Stride,ResultDim,BlockSize) for i in xrange(n1)]
+        if NumProcs>1:
+            Pool=multiprocessing.Pool(NumProcs)
+            Results=Pool.imap(_EvaluateBlockObservable,Args)
+        else:
+            Pool=None
+            Results=(_EvaluateBlockObservable(x) for x in Args)
+        try:
+            for i,Values in enumerate(Results):
+                print(i)
+                Ans[i,:len(Values)]=Values
+        finally:
+            if Pool!=None:
+                Pool.terminate()
+        if OutFilename!=None:
+            Ans.flush()
+        return(Ans)
+
+    def CalcStateObservables(self,Ass,Observables,NumStates=None,Histograms=None,Subsampling=1,WhichTrajs=None):
+        """Evaluate several block observables in a single pass over the dataset, reducing them on the fly to per-state statistics.
+
+        Inputs:
+        Ass: a 2d array of assignments, padded with negative ones.  Row i holds the assignments of trajectory WhichTrajs[i].
+        Observables: a dictionary mapping names to block observables (see EvaluateBlockObservableAcrossProject) that return one float per conformation, such as RMSDObservable or RadiusOfGyrationObservable.
+
+        Keyword Arguments:
+        NumStates: the number of states.  Default: None (uses max(Ass)+1)
+        Histograms: a dictionary mapping observable names to arrays of bin edges.  The per-state histograms of those observables are accumulated too.
+        Subsampling: the stride used for assignment; Ass[i,j] is the state of frame j*Subsampling.
+        WhichTrajs: the trajectories that the rows of Ass belong to.  Default: None (all trajectories)
+
+        Notes:
+        Returns a dictionary mapping each observable name to a dictionary with the per-state "Counts", "Mean" and "Variance" (NaN for empty states), and "Histogram" (NumStates x NumBins) if bin edges were given.  Each trajectory is read once whatever the number of observables, and no per-conformation results are kept.
+        """
+        Ass=np.asarray(Ass)
+        if NumStates==None:
+            NumStates=max(Ass.max()+1,0)
+        if Histograms==None:
+            Histograms={}
+        if WhichTrajs is None:
+            WhichTrajs=np.arange(self["NumTrajs"])
+        Counts=np.zeros(NumStates,dtype='int')
+        Shift=dict([(Name,None) for Name in Observables])
+        Sum=dict([(Name,np.zeros(NumStates)) for Name in Observables])
+        SumSq=dict([(Name,np.zeros(NumStates)) for Name in Observables])
+        Hist=dict([(Name,np.zeros((NumStates,len(Histograms[Name])-1),dtype='int')) for Name in Histograms])
+        for i,(TrajNumber,Traj) in enumerate(self.IterTrajectories(WhichTrajs)):
+            print("Evaluating observables for Trajectory %d"%TrajNumber)
+            XYZList=Traj.pop("XYZList")[::Subsampling]
+            del Traj
+            n=min(len(XYZList),Ass.shape[1])
+            States=Ass[i,:n]
+            Mask=(States>=0)&(States<NumStates)
+            States=States[Mask]
+            if len(States)==0:
+                continue
+            Counts+=np.bincount(States,minlength=NumStates)
+            for Name,f in Observables.items():
+                Values=np.asarray(f(XYZList[:n]),dtype='float64').reshape((-1,))[Mask]
+                if len(Values)==0:
+                    continue
+                if Shift[Name] is None:#Accumulating values relative to the first one keeps the variance numerically stable.
+                    Shift[Name]=Values[0]
+                Values=Values-Shift[Name]
+                Sum[Name]+=np.bincount(States,weights=Values,minlength=NumStates)
+                SumSq[Name]+=np.bincount(States,weights=Values**2,minlength=NumStates)
+                if Name in Histograms:
+                    Edges=np.asarray(Histograms[Name])
+                    NumBins=len(Edges)-1
+                    Bins=np.searchsorted(Edges,Values+Shift[Name],side='right')-1
+                    Bins[Values+Shift[Name]==Edges[-1]]=NumBins-1
+                    InRange=(Bins>=0)&(Bins<NumBins)
+                    Hist[Name]+=np.bincount(States[InRange]*NumBins+Bins[InRange],minlength=NumStates*NumBins).reshape((NumStates,NumBins))
+            del XYZList
+        Results={}
+        Nonempty=Counts>0
+        for Name in Observables:
+            Mean=np.nan*np.ones(NumStates)
+            Variance=np.nan*np.ones(NumStates)
+            if Shift[Name] is not None:
+                M=Sum[Name][Nonempty]/Counts[Nonempty]
+                Mean[Nonempty]=Shift[Name]+M
+                Variance[Nonempty]=np.maximum(SumSq[Name][Nonempty]/Counts[Nonempty]-M**2,0.)
+            Results[Name]={"Counts":Counts.copy(),"Mean":Mean,"Variance":Variance}
+            if Name in Histograms:
+                Results[Name]["Histogram"]=Hist[Name]
+        return(Results)
+
     def GetEmptyTrajectory(self):
-        """This creates a trajectory with the correct atoms and residues, but leaves the coordinate data empty (XYZList)."""
-        Traj=self.LoadTraj(0)
+        """This creates a trajectory with the correct atoms and residues, but leaves the coordinate data empty (XYZList).  The topology of the first trajectory is read from disk once, and each call returns a copy of it."""
+        Filename=self.GetTrajFilename(0)
+        if getattr(self,"_EmptyTrajectory",None) is None or self._EmptyTrajectory[0]!=Filename:
+            Traj=Trajectory.Trajectory.LoadTrajectoryTopology(Filename,Conf=self.Conf)
+            Traj.pop("XYZList")
+            self._EmptyTrajectory=(Filename,Traj)
+        Traj=Trajectory.Trajectory(self._EmptyTrajectory[1])
         Traj.pop("XYZList")
         return(Traj)
         
     def EnumerateTrajs(self):
         """List which trajectories we have."""
         return(np.arange(self["NumTrajs"][0]))
-    def GetRandomConfsFromEachState(self,Ass,NumStates,NumConf,Subsampling=1,JustGetIndices=False):
-        """Given a set of Assignments data (Ass) with (NumStates) states, grab (NumConf) conformations from each state.  This returns a trajectory with all the conformations.  If you just want to know what trajectory / snapshot the conformations came from, set JustGetIndices=True."""
+    def GetRandomConfsFromEachState(self,Ass,NumStates,NumConf,Subsampling=1,JustGetIndices=False,Replace=True):
+        """Given a set of Assignments data (Ass) with (NumStates) states, grab (NumConf) conformations from each state.  This returns a trajectory with all the conformations.  If you just want to know what trajectory / snapshot the conformations came from, set JustGetIndices=True; this returns a list with one (n,2) array of (trajectory, frame) pairs per state.  Set Replace=False to sample without replacement within each state, in which case states with fewer than NumConf conformations contribute all of them (and empty states none)."""
+        StateIndex=BuildStateIndex(Ass,NumStates=NumStates)
         Trj=self.GetEmptyTrajectory()
-        Trj["XYZList"]=[]
+        Samples=[]
         for i in range(NumStates):
             print("Getting Conformations For state %d"%i)
-            XYZList=self.GetRandomConfsFromState(Ass,i,NumConf,Subsampling=Subsampling,JustGetIndices=JustGetIndices)
-            Trj["XYZList"].append(XYZList)
-        Trj["XYZList"]=np.array(Trj["XYZList"])
-        if JustGetIndices==False:
-            m0,m1,m2,m3=Trj["XYZList"].shape
-            Trj["XYZList"]=Trj["XYZList"].reshape((m0*m1,m2,m3))
+            XYZList=self.GetRandomConfsFromState(Ass,i,NumConf,Subsampling=Subsampling,JustGetIndices=JustGetIndices,Replace=Replace,StateIndex=StateIndex)
+            Samples.append(XYZList)
+        if JustGetIndices==True:
+            return([np.reshape(x,(-1,2)).astype('int') for x in Samples])
+        Samples=[x for x in Samples if len(x)>0]
+        if len(Samples)==0:
+            Trj["XYZList"]=np.zeros((0,Trj.GetNumberOfAtoms(),3),dtype='float32')
         else:
-            Trj=Trj["XYZList"]
+            Trj["XYZList"]=np.concatenate(Samples)
         return(Trj)
-    def GetRandomConfsFromState(self,Ass,state,NumConf,Subsampling=1,JustGetIndices=False):
-        """Given a set of assignments (Ass: a numpy array), grab random conformations from this state.  If you would rather just grab indices of conformations, set JustGetIndices=True.  Note that This function assumes that we have the assignments loaded in memory, which we may want to fix later on."""
-        ind=np.where(Ass==state)
-        # print(ind) # TJL turned off excessive verbosity
-        M=len(ind[0])
-        XYZList=[]
-        try:
+    def GetRandomConfsFromState(self,Ass,state,NumConf,Subsampling=1,JustGetIndices=False,Replace=True,StateIndex=None):
+        """Given a set of assignments (Ass: a numpy array), grab random conformations from this state.  If you would rather just grab indices of conformations, set JustGetIndices=True.  Set Replace=False to sample without replacement (returning at most all conformations in the state).  When sampling many states, pass a StateIndex from BuildStateIndex(Ass) so that the assignments are only scanned once.  Note that This function assumes that we have the assignments loaded in memory, which we may want to fix later on."""
+        if StateIndex==None:
+            StateIndex=BuildStateIndex(Ass,NumStates=state+1)
+        IndPtr,Conformations=StateIndex
+        if state+1>=len(IndPtr):
+            return(np.array([]))
+        StateConfs=Conformations[IndPtr[state]:IndPtr[state+1]]
+        M=len(StateConfs)
+        if M==0:
+            return(np.array([]))
+        if Replace:
             RND=np.random.random_integers(0,M-1,NumConf)
-            for r in RND:
-                k1=ind[0][r]
-                k2=ind[1][r]*Subsampling
-                # print("k1,k2",k1,k2)
-                if not JustGetIndices:
-                    XYZList.append(self.ReadFrame(k1,k2))
-                else:
-                    XYZList.append((k1,k2))
-        except ValueError:
-            pass
-        return(np.array(XYZList))
+        else:
+            RND=np.random.permutation(M)[:NumConf]
+        Which=StateConfs[RND]
+        Which[:,1]*=Subsampling
+        if JustGetIndices:
+            return(Which)
+        return(self.ReadConformations(Which))
     def AssignProject(self,Generators,AtomIndices=None,WhichTrajs=None):
         """Given a set of Generators (a trajectory), assign each conformation in the dataset to Generators."""
         if AtomIndices==None:
@@ -144,10 +404,8 @@ class Project(Serializer.Serializer):
 
         Gens=Generators["XYZList"][:,AtomIndices].copy()
 
-        for i in range(len(WhichTrajs)):
-            print("Assigning Trajectory %d"%WhichTrajs[i])
-            
-            R1=self.LoadTraj(WhichTrajs[i])
+        for i,(TrajNumber,R1) in enumerate(self.IterTrajectories(WhichTrajs)):
+            print("Assigning Trajectory %d"%TrajNumber)
 
             Ass,AssRMSD=Clustering.KCenters.Assign(Gens,R1["XYZList"][:,AtomIndices])
 
@@ -162,31 +420,37 @@ class Project(Serializer.Serializer):
         N1=self["TrajLengths"].shape[0]
         N2=max(self["TrajLengths"])
         RMSDArray=-1*np.ones((N1,N2))
-        for i in range(N1):
+        for i,Traj in self.IterTrajectories():
             print(i)
-            R1["XYZList"]=self.LoadTraj(i)["XYZList"][:]
+            R1["XYZList"]=Traj.pop("XYZList")
+            del Traj
             rmsd=R1.CalcRMSD(C1,ind0,ind1)
             del R1["XYZList"]
             RMSDArray[i,0:len(rmsd)]=rmsd
         return(RMSDArray)
     def GetConformations(self,Which):
         """Get a trajectory containing the conformations specified by Which. Which should be a 2d array, such that Which[i]=x,y. x is the trajectory number, and y is the frame number."""
-        N1=len(Which)
         Trj=self.GetEmptyTrajectory()
-
-        NumAtoms=len(Trj["AtomNames"])
-        NumAxes=3
-        Current=0
-
-        Trj["XYZList"]=np.zeros((0,NumAtoms,NumAxes),dtype='float32')
-        for i in range(N1):
-            X=self.ReadFrame(Which[i,0],Which[i,1])
-            Trj["XYZList"].resize((Current+len(X),NumAtoms,NumAxes))
-            Trj["XYZList"][Current:Current+len(X)]=X
-            Current+=len(X)
-            
-        Trj["XYZList"]=np.array(Trj["XYZList"],dtype='float32')
+        Trj["XYZList"]=self.ReadConformations(Which)
         return(Trj)
+
+    def ReadConformations(self,Which):
+        """Return an array with the coordinates of the conformations specified by Which (see GetConformations).  The reads are grouped by trajectory, and the frames of each trajectory are read in ascending order."""
+        Which=np.array(Which,dtype='int').reshape((-1,2))
+        if len(Which)==0:
+            return(np.zeros((0,len(self.Conf["AtomNames"]),3),dtype='float32'))
+        Order=np.argsort(Which[:,0],kind="mergesort")
+        Trajs=Which[Order,0]
+        Starts=np.concatenate(([0],np.where(np.diff(Trajs)!=0)[0]+1))
+        Stops=np.concatenate((Starts[1:],[len(Trajs)]))
+        XYZList=None
+        for a,b in zip(Starts,Stops):
+            Ind=Order[a:b]
+            X=self.ReadFrames(Trajs[a],Which[Ind,1])
+            if XYZList is None:
+                XYZList=np.zeros((len(Which),)+X.shape[1:],dtype='float32')
+            XYZList[Ind]=X
+        return(XYZList)
     
     def ClusterProject(self,NumGen,AtomIndices=None,GetRandomConformations=False,NumConfsToGet=None,Which=None,Stride=1,SkipKCenters=False,DiscardFirstN=0,DiscardLastN=0,GlobalKMedoidIterations=0,LocalKMedoidIterations=0,RMSDCutoff=-1.,NormExponent=2.,StartingIndices=None):
         """Cluster the project into geometric states using either k-centers or (hybrid) k-medoids.
@@ -249,8 +513,7 @@ class Project(Serializer.Serializer):
     def GetAllConformations(self,Stride=1,Which=None,AtomIndices=None,DiscardFirstN=0,DiscardLastN=0):
         """Get all conformations from this dataset.  Setting Stride=N allows you to select every Nth conformation.  Setting Which allows you to specify which trajectories to grab from.  Setting AtomIndices will select coordinates from specific atoms."""
         if AtomIndices==None:
-            Traj=self.LoadTraj(0)
-            AtomIndices=np.arange(Traj["XYZList"].shape[1])
+            AtomIndices=np.arange(len(self.GetEmptyTrajectory()["AtomNames"]))
 
         XYZList=[]
         if Which==None:
@@ -261,8 +524,7 @@ class Project(Serializer.Serializer):
         
         XYZList=np.zeros((0,NumAtoms,NumAxes),dtype='float32')
         Current=0
-        for i in Which:
-            Traj=self.LoadTraj(i)
+        for i,Traj in self.IterTrajectories(Which):
             TrajLen=Traj["XYZList"].shape[0]
 
             X=Traj["XYZList"][DiscardFirstN:(TrajLen-DiscardLastN):Stride][:,AtomIndices]
@@ -294,19 +556,17 @@ class Project(Serializer.Serializer):
             k=k+N
         return(Data)
     def GetRandomConformations(self,NumConfs,Which=None):
-        """Now without replacement!"""
+        """Now without replacement!  Duplicate draws are dropped, keeping the order of first appearance."""
         ConfIndices=self.EnumerateConformations(Which=Which)
         R1=np.random.random_integers(0,len(ConfIndices)-1,NumConfs)
-        R2=[]
-        for r in R1:
-            if r not in R2:
-                R2.append(r)
+        First=np.unique(R1,return_index=True)[1]
+        R2=R1[np.sort(First)]
         RandIndices=ConfIndices[R2]
         Trj=self.GetConformations(RandIndices)
         return(Trj["XYZList"])
     
-    def SavePDBs(self,Ass,OutDir,NumConf,States=None):
-        """Get random conformations from each state, then save them in directory OutDir.  Returns a Trajectory containing the conformations."""
+    def SavePDBs(self,Ass,OutDir,NumConf,States=None,SingleFile=False):
+        """Get random conformations from each state, then save them in directory OutDir.  Returns a Trajectory containing the conformations.  With SingleFile, each state is saved as one multi-model PDB, OutDir/State%d.pdb."""
         NumStates=max(Ass.flatten())+1
         try:
             os.mkdir(OutDir)
@@ -317,14 +577,22 @@ class Project(Serializer.Serializer):
 
         if States==None:
             States=xrange(NumStates)
+        StateIndex=BuildStateIndex(Ass,NumStates=NumStates)
     
         for i in States:
             print(i)
-            Outfile=OutDir+"/State%d-%d.pdb"%(i, NumConf-1)
+            if SingleFile==True:
+                Outfile=OutDir+"/State%d.pdb"%i
+            else:
+                Outfile=OutDir+"/State%d-%d.pdb"%(i, NumConf-1)
             if os.path.exists(Outfile):
                 print "  already done, skipping"
                 continue
-            R1["XYZList"]=self.GetRandomConfsFromState(Ass,i,NumConf)
+            R1["XYZList"]=self.GetRandomConfsFromState(Ass,i,NumConf,StateIndex=StateIndex)
+            if SingleFile==True:
+                print("Saving State %d as %s"%(i,Outfile))
+                R1.SaveToPDB(Outfile,Models=True)
+                continue
             for j in xrange(NumConf):
                 Outfile=OutDir+"/State%d-%d.pdb"%(i,j)
                 print("Saving State %d Conf %d as %s"%(i,j,Outfile))
@@ -346,8 +614,72 @@ def CountLocalTrajectories(TrajFilePath,TrajFileBaseName,TrajFileType):
         else:
             Unfinished=False
     return(i)
-def CreateProjectFromDir(Filename="ProjectInfo.h5",TrajFilePath="./Trajectories/",TrajFileBaseName="trj",TrajFileType=".h5",ConfFilename=None,RunList=None,CloneList=None,NumGensList=None):
-    """By default, the files should be of the form ./Trajectories/trj0.h5 ... ./Trajectories/trj[n].h5.  Use optional arguments to change path, names, and filetypes."""
+def _InspectTrajectory(Args):
+    """Return (NumFrames,NumAtoms) of a trajectory file.  This is a module-level function so that it can be run in worker processes by InspectTrajectories."""
+    Filename,Conf=Args
+    Shape=Trajectory.Trajectory.LoadTrajectoryFile(Filename,JustInspect=True,Conf=Conf)
+    return(int(Shape[0]),int(Shape[1]))
+
+def InspectTrajectories(Filenames,Conf=None,ManifestFilename=None,NumProcs=None):
+    """Find the number of frames and atoms of each trajectory file in Filenames.
+
+    Keyword Arguments:
+    Conf: the Conformation used to read XTC and DCD files.
+    ManifestFilename: an HDF5 file that records the length, atom count, size and modification time of every trajectory file inspected so far.  Only files that are new or have changed since they were recorded are inspected, and the manifest is then updated.  Default: None (inspect everything)
+    NumProcs: the number of worker processes used to inspect files.  Default: None (one per CPU)
+
+    Notes:
+    Returns (TrajLengths,NumAtoms) arrays.
+    """
+    Filenames=list(Filenames)
+    Manifest={}
+    if ManifestFilename!=None and os.path.exists(ManifestFilename):
+        M=Serializer.Serializer.LoadFromHDF(ManifestFilename)
+        Columns=[np.array(M[key]).reshape((-1,)) for key in ["Filenames","TrajLengths","NumAtoms","FileSizes","ModTimes"]]
+        for Row in zip(*Columns):
+            Manifest[Row[0]]=tuple(Row[1:])
+    Keys=[os.path.abspath(f) for f in Filenames]
+    Stats=[os.stat(f) for f in Filenames]
+    ToInspect=[]
+    for i,Key in enumerate(Keys):
+        if not (Key in Manifest and Manifest[Key][2]==Stats[i].st_size and Manifest[Key][3]==Stats[i].st_mtime):
+            ToInspect.append(i)
+    print("Inspecting %d of %d trajectories"%(len(ToInspect),len(Filenames)))
+    Args=[(Filenames[i],Conf) for i in ToInspect]
+    if NumProcs==None:
+        NumProcs=multiprocessing.cpu_count()
+    NumProcs=min(NumProcs,len(Args))
+    if NumProcs>1:
+        Pool=multiprocessing.Pool(NumProcs)
+        try:
+            Shapes=Pool.map(_InspectTrajectory,Args)
+        finally:
+            Pool.terminate()
+    else:
+        Shapes=[_InspectTrajectory(x) for x in Args]
+    for i,Shape in zip(ToInspect,Shapes):
+        Manifest[Keys[i]]=(Shape[0],Shape[1],Stats[i].st_size,Stats[i].st_mtime)
+    if ManifestFilename!=None and len(ToInspect)>0:
+        SaveTrajectoryManifest(ManifestFilename,Manifest)
+    TrajLengths=np.array([Manifest[Key][0] for Key in Keys],dtype='int')
+    NumAtoms=np.array([Manifest[Key][1] for Key in Keys],dtype='int')
+    return(TrajLengths,NumAtoms)
+
+def SaveTrajectoryManifest(ManifestFilename,Manifest):
+    """Write a manifest (a dictionary mapping absolute filenames to (TrajLength,NumAtoms,FileSize,ModTime)) to an HDF5 file, replacing any previous version."""
+    Keys=sorted(Manifest.keys())
+    M=Serializer.Serializer({"Filenames":np.array(Keys),
+                             "TrajLengths":np.array([Manifest[Key][0] for Key in Keys],dtype='int'),
+                             "NumAtoms":np.array([Manifest[Key][1] for Key in Keys],dtype='int'),
+                             "FileSizes":np.array([Manifest[Key][2] for Key in Keys],dtype='int'),
+                             "ModTimes":np.array([Manifest[Key][3] for Key in Keys],dtype='float64')})
+    if os.path.exists(ManifestFilename):
+        os.remove(ManifestFilename)
+    M.SaveToHDF(ManifestFilename)
+
+def CreateProjectFromDir(Filename="ProjectInfo.h5",TrajFilePath="./Trajectories/",TrajFileBaseName="trj",TrajFileType=".h5",ConfFilename=None,RunList=None,CloneList=None,NumGensList=None,ManifestFilename="./Data/TrajManifest.h5",NumProcs=None):
+    """By default, the files should be of the form ./Trajectories/trj0.h5 ... ./Trajectories/trj[n].h5.  Use optional arguments to change path, names, and filetypes.  Trajectory lengths are cached in ManifestFilename (see InspectTrajectories)."""
+    Conf=None
     if ConfFilename!=None:
         Conf=Conformation.Conformation.LoadFromPDB(ConfFilename)
             
@@ -355,10 +687,12 @@ def CreateProjectFromDir(Filename="ProjectInfo.h5",TrajFilePath="./Trajectories/
     if NumTraj==0:
         print("No data found!  ERROR")
         return
-    LenList=[]
-    for i in range(NumTraj):
-        f=GetTrajFilename(TrajFilePath,TrajFileBaseName,TrajFileType,i)
-        LenList.append(Trajectory.Trajectory.LoadTrajectoryFile(f,JustInspect=True,Conf=Conf)[0])
+    try:
+        os.mkdir("./Data")
+    except OSError:
+        pass
+    Filenames=[GetTrajFilename(TrajFilePath,TrajFileBaseName,TrajFileType,i) for i in range(NumTraj)]
+    LenList=InspectTrajectories(Filenames,Conf=Conf,ManifestFilename=ManifestFilename,NumProcs=NumProcs)[0]
 
     DictContainer={"TrajLengths":np.array(LenList),"TrajFilePath":TrajFilePath,"TrajFileBaseName":TrajFileBaseName,"TrajFileType":TrajFileType,"ConfFilename":ConfFilename}
     if RunList!=None:
@@ -370,10 +704,6 @@ def CreateProjectFromDir(Filename="ProjectInfo.h5",TrajFilePath="./Trajectories/
     P1=Project(DictContainer)
     if Filename!=None:
         P1.SaveToHDF(Filename)
-    try:
-        os.mkdir("./Data")
-    except OSError:
-        pass
     return P1
 def GetTrajFilename(TrajFilePath,TrajFileBaseName,TrajFileType,TrajNumber):
     """This is a helper function to construct a filename for a trajectory file."""
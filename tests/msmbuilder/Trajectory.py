@@ -19,25 +19,32 @@
 """Trajectory stores a sequence of conformations.
 """
 
+import os
 import tables
 import numpy as np
+import scipy.sparse
 
-from msmbuilder import PDB, Conformation, Serializer, xtc, dcd, DistanceMetric
+from msmbuilder import PDB, GRO, Conformation, Serializer, xtc, dcd, DistanceMetric
 RMSD=DistanceMetric.RMSD
 
 MAXINT16=32766
 
 
 def ConvertToLossyIntegers(X,Precision):
-    """Implementation of the lossy compression used in Gromacs XTC using the pytables library.  Convert 32 bit floats into 16 bit integers.  These conversion functions have been optimized for memory use.  Further memory reduction would require an in-place astype() operation, which one could create using ctypes."""
+    """Implementation of the lossy compression used in Gromacs XTC using the pytables library.  Convert 32 bit floats into 16 bit integers.  These conversion functions have been optimized for memory use.  Further memory reduction would require an in-place astype() operation, which one could create using ctypes.  Read-only arrays (e.g. Trajectory views, see Trajectory.GetView) are scaled into a temporary array instead of in place.  Values are rounded to the nearest integer, as in XTC files and Trajectory.ConvertXTCToLHDF."""
+    InPlace=isinstance(X,np.ndarray) and X.flags.writeable
     if np.max(X)*float(Precision)< MAXINT16 and np.min(X)*float(Precision) > -MAXINT16:
-        X*=float(Precision)
-        Rounded=X.astype("int16")
-        X/=float(Precision)
+        Type="int16"
     else:
+        Type="int32"
+    Rounded=np.empty(np.shape(X),dtype=Type)
+    if InPlace:
         X*=float(Precision)
-        Rounded=X.astype("int32")
+        np.rint(X,out=Rounded,casting="unsafe")
         X/=float(Precision)
+    else:
+        np.rint(np.multiply(X,float(Precision)),out=Rounded,casting="unsafe")
+    if Type=="int32":
         print("Data range too large for int16: try removing center of mass motion, check for 'blowing up, or just use .h5 or .xtc format.'")
     return(Rounded)
 
@@ -47,6 +54,110 @@ def ConvertFromLossyIntegers(X,Precision):
     X2/=float(Precision)
     return(X2)
 
+def CanTranscodeXTCExactly(XTCFilenameList,Precision=1000):
+    """Return True if every frame of the XTC files was written at Precision and its quantized coordinates fit in int16, judging from the frame headers only.  The LHDF integers are then exactly the XTC integers (see Trajectory.ConvertXTCToLHDF)."""
+    if isinstance(XTCFilenameList,str):
+        XTCFilenameList=[XTCFilenameList]
+    for Filename in XTCFilenameList:
+        Precisions,MinInts,MaxInts=xtc.scan_xtc_headers(Filename,quantization=True)[3:]
+        if len(Precisions)==0:
+            continue
+        if not np.all(Precisions==np.float32(Precision)):#XTC stores the precision as a float32, so it can be compared exactly.
+            return(False)
+        if MaxInts.max()>=MAXINT16 or MinInts.min()<=-MAXINT16:
+            return(False)
+    return(True)
+
+def GetSliceFromIndices(Indices):
+    """Return a slice selecting the same items as Indices, if Indices is evenly spaced and increasing, else Indices as an array.  Slices index numpy arrays without copying."""
+    if Indices is None or isinstance(Indices,slice):
+        return(Indices)
+    Indices=np.asarray(Indices,'int').reshape(-1)
+    if len(Indices)==0 or Indices.min()<0:
+        return(Indices)
+    if len(Indices)==1:
+        return(slice(Indices[0],Indices[0]+1))
+    Step=Indices[1]-Indices[0]
+    if Step>0 and np.all(np.diff(Indices)==Step):
+        return(slice(Indices[0],Indices[-1]+1,Step))
+    return(Indices)
+
+def GetReadOnlyView(X):
+    """Return a read-only numpy view of X, sharing its memory and leaving X itself writable."""
+    View=np.asarray(X).view()
+    View.flags.writeable=False
+    return(View)
+
+_XTCFrameIndexCache={}
+
+def GetXTCFrameIndexFilename(Filename):
+    """Return the filename of the sidecar file that caches the frame offsets of an XTC file."""
+    return(Filename+".idx")
+
+def LoadXTCFrameIndex(Filename):
+    """Return the byte offset of each frame in an XTC file.
+
+    Notes:
+    The offsets are found by reading frame headers only, and are cached in memory and in a sidecar HDF5 file next to the XTC file.  The cache is rebuilt whenever the size or modification time of the XTC file changes.  If the sidecar cannot be written (e.g. a read-only directory), only the in-memory cache is used.
+    """
+    Stat=os.stat(Filename)
+    Key=os.path.abspath(Filename)
+    if Key in _XTCFrameIndexCache:
+        Size,ModTime,Offsets=_XTCFrameIndexCache[Key]
+        if Size==Stat.st_size and ModTime==Stat.st_mtime:
+            return(Offsets)
+    IndexFilename=GetXTCFrameIndexFilename(Filename)
+    Offsets=None
+    if os.path.exists(IndexFilename):
+        try:
+            S=Serializer.Serializer.LoadFromHDF(IndexFilename)
+            if S["FileSize"]==Stat.st_size and S["ModTime"]==Stat.st_mtime:
+                Offsets=np.array(S["Offsets"],dtype='int64').reshape((-1,))
+        except Exception:
+            pass
+    if Offsets is None:
+        Offsets=xtc.xtc_frame_offsets(Filename)
+        try:
+            if os.path.exists(IndexFilename):
+                os.remove(IndexFilename)
+            Serializer.Serializer({"Offsets":Offsets,"FileSize":Stat.st_size,"ModTime":Stat.st_mtime}).SaveToHDF(IndexFilename)
+        except Exception:
+            print("Could not write XTC frame index %s"%IndexFilename)
+    _XTCFrameIndexCache[Key]=(Stat.st_size,Stat.st_mtime,Offsets)
+    return(Offsets)
+
+def GetCoordinateSidecarFilename(Filename):
+    """Return the filename of the uncompressed float32 coordinate file kept next to an LHDF trajectory."""
+    return(Filename+".npy")
+
+def WriteCoordinateSidecar(Filename,Precision=1000,ChunkSize=1000):
+    """Write the coordinates of an LHDF trajectory to an uncompressed float32 .npy file next to it (see GetCoordinateSidecarFilename).
+
+    Notes:
+    The file is a standard .npy file (a short header followed by the raw (NumFrames,NumAtoms,3) array), so it can be opened with np.load(...,mmap_mode='r') or np.memmap.  It is written ChunkSize frames at a time, so the trajectory is never held in memory as a whole.  Once present (and newer than the LHDF file), LoadFromLHDF, ReadLHDF5Frame and ReadFrames read coordinates from it instead of decompressing and dequantizing the LHDF file.
+    """
+    SidecarFilename=GetCoordinateSidecarFilename(Filename)
+    TempFilename=SidecarFilename+".tmp"
+    F1=tables.File(Filename,'r')
+    try:
+        Node=F1.root.XYZList
+        X=np.lib.format.open_memmap(TempFilename,mode='w+',dtype='float32',shape=Node.shape)
+        for Start in range(0,Node.shape[0],ChunkSize):
+            X[Start:Start+ChunkSize]=ConvertFromLossyIntegers(Node[Start:Start+ChunkSize],Precision)
+        X.flush()
+        del X
+    finally:
+        F1.close()
+    os.rename(TempFilename,SidecarFilename)
+    return(SidecarFilename)
+
+def LoadCoordinateSidecar(Filename):
+    """Return a copy-on-write memory map of the coordinate sidecar of an LHDF trajectory, or None if there is no sidecar or it is older than the trajectory.  Changing the returned array never changes the file."""
+    SidecarFilename=GetCoordinateSidecarFilename(Filename)
+    if not os.path.exists(SidecarFilename) or os.path.getmtime(SidecarFilename)<os.path.getmtime(Filename):
+        return(None)
+    return(np.load(SidecarFilename,mmap_mode='c'))
+
 class Trajectory(Conformation.ConformationBaseClass):
     """This is the representation of a sequence of  conformations.
 
@@ -62,6 +173,41 @@ class Trajectory(Conformation.ConformationBaseClass):
         self["XYZList"]=[]
         if "XYZList" in S: self["XYZList"]=S["XYZList"].copy()
 
+    def GetView(self,Frames=None,AtomIndices=None):
+        """Return a Trajectory over frames Frames and atoms AtomIndices of this one, without copying coordinates where possible.
+
+        Keyword Arguments:
+        Frames -- A slice or frame indices.  Default: None (all frames)
+        AtomIndices -- A slice or atom indices.  Default: None (all atoms)
+
+        Notes:
+        XYZList and the topology arrays of the view are read-only numpy views of this Trajectory's arrays whenever the selections are slices (or evenly spaced indices, see GetSliceFromIndices); other selections are gathered once.  Call MakeWritable before changing a view in place, which copies its data.
+        """
+        Frames=GetSliceFromIndices(Frames)
+        AtomIndices=GetSliceFromIndices(AtomIndices)
+        View=self.__class__.__new__(self.__class__)
+        dict.update(View,self)
+        for key in ["ChainID","AtomNames","ResidueNames","AtomID","ResidueID"]:
+            if AtomIndices is None:
+                View[key]=GetReadOnlyView(self[key])
+            else:
+                View[key]=GetReadOnlyView(np.asarray(self[key])[AtomIndices])
+        X=np.asarray(self["XYZList"])
+        if Frames is not None:
+            X=X[Frames]
+        if AtomIndices is not None:
+            X=X[:,AtomIndices]
+        View["XYZList"]=GetReadOnlyView(X)
+        if AtomIndices is not None:
+            View.UpdateIndexList()
+        return(View)
+
+    def MakeWritable(self):
+        """Copy any read-only arrays of a view (see GetView) so that they can be changed in place without changing the Trajectory they came from."""
+        for key in ["XYZList","ChainID","AtomNames","ResidueNames","AtomID","ResidueID"]:
+            if isinstance(self.get(key),np.ndarray) and not self[key].flags.writeable:
+                self[key]=self[key].copy()
+
     def CalcRMSD(self,Conf=None,Ind0=None,Ind1=None):
         """Calculate the RMSD between a trajectory and another object.
 
@@ -79,47 +225,129 @@ class Trajectory(Conformation.ConformationBaseClass):
         if Ind1==None:
             Ind1=range(len(self["XYZList"][0]))
         if Conf==None:
-            print("Calculating Pairwise RMSD")
-            RData1=RMSD.PrepareData(self["XYZList"][:,Ind0])
-            RMat=np.zeros((n,n),'float32')
-            for i in range(n):
-                RMat[i]=RMSD.GetFastMultiDistance(RData1,RData1,i)
-            return(RMat)
+            return(self.CalcPairwiseRMSD(AtomIndices=Ind0))
         else:
             RVec=RMSD.GetMultiDistance(self["XYZList"][:,Ind0],Conf["XYZ"][Ind1])
             return(RVec)
-    def SaveToLHDF(self,Filename,Precision=1000):
-        """Save a Trajectory instance to a Lossy HDF File.  First, remove the XYZList key because it should be written using the special CArray operation.  This file format is roughly equivalent to an XTC and should comparable file sizes but with better IO performance."""
+
+    def CalcPairwiseRMSD(self,AtomIndices=None,Output="dense",Cutoff=None,OutFilename=None,MaxBytes=256*1024**2):
+        """Calculate the RMSD between all pairs of frames, one block of rows at a time.
+
+        Keyword Arguments:
+        AtomIndices -- Which atom indices to use.  Default: None (which uses ALL atoms)
+        Output -- "dense": an n x n array.  "condensed": the upper triangle (i<j) as a vector of length n(n-1)/2, ordered as in scipy.spatial.distance.squareform.  "sparse": a symmetric scipy.sparse CSR matrix holding only the pairs with RMSD below Cutoff (the diagonal is left out).  "hdf5": the n x n matrix is written to OutFilename (readable with Serializer.LoadData), and OutFilename is returned.  Default: "dense"
+        Cutoff -- The RMSD cutoff for sparse output.
+        OutFilename -- Required for hdf5 output.  With condensed output, the vector is written to this .npy file and returned as a memory map.
+        MaxBytes -- An upper bound on the memory used for a block of rows.  Default: 256 MB
+
+        Notes:
+        Each pair (i,j) is computed once for j>=i (up to pairs within a block), and only the dense output holds the whole matrix in memory.
+        """
+        n=len(self["XYZList"])
+        if AtomIndices is None:
+            AtomIndices=np.arange(self["XYZList"].shape[1])
+        print("Calculating Pairwise RMSD")
+        RData=RMSD.PrepareData(self["XYZList"][:,AtomIndices])
+        BlockSize=int(max(1,min(n,MaxBytes//(4*max(n,1)))))
+        if Output=="dense":
+            Result=np.zeros((n,n),'float32')
+        elif Output=="condensed":
+            if OutFilename!=None:
+                Result=np.lib.format.open_memmap(OutFilename,mode='w+',dtype='float32',shape=(n*(n-1)//2,))
+            else:
+                Result=np.zeros(n*(n-1)//2,'float32')
+        elif Output=="sparse":
+            if Cutoff==None:
+                raise Exception("Sparse pairwise RMSD needs a Cutoff.")
+            PairRows,PairCols,PairValues=[],[],[]
+        elif Output=="hdf5":
+            if OutFilename==None:
+                raise Exception("Pairwise RMSD output to HDF5 needs an OutFilename.")
+            Serializer.CheckIfFileExists(OutFilename)
+            F1=tables.File(OutFilename,'w')
+            Side=min(max(n,1),int(np.sqrt(Serializer.CHUNK_BYTES/4)))#Square chunks, so that the transposed strips read back below touch few chunks.
+            Node=F1.createCArray("/","Data",tables.Float32Atom(),(n,n),filters=Serializer.Filter,chunkshape=(Side,Side))
+        else:
+            raise Exception("Unknown pairwise RMSD output %s; choose dense, condensed, sparse or hdf5"%Output)
+
+        try:
+            for Start in range(0,n,BlockSize):
+                Stop=min(Start+BlockSize,n)
+                Columns=RData.GetSubset(Start,n)
+                Block=np.empty((Stop-Start,n-Start),'float32')#Block[r,c] is the RMSD between frames Start+r and Start+c
+                for i in range(Start,Stop):
+                    Block[i-Start]=RMSD.GetFastMultiDistance(RData,Columns,i)
+                if Output=="dense":
+                    Result[Start:Stop,Start:]=Block
+                    Result[Start:,Start:Stop]=Block.T
+                elif Output=="condensed":
+                    for i in range(Start,Stop):
+                        Offset=i*n-i*(i+1)//2
+                        Result[Offset:Offset+n-i-1]=Block[i-Start,i-Start+1:]
+                elif Output=="sparse":
+                    r,c=np.nonzero(Block<Cutoff)
+                    Upper=c>r
+                    PairRows.append(r[Upper]+Start)
+                    PairCols.append(c[Upper]+Start)
+                    PairValues.append(Block[r[Upper],c[Upper]])
+                else:
+                    Rows=np.empty((Stop-Start,n),'float32')
+                    Rows[:,Start:]=Block
+                    if Start>0:#The lower triangle of these rows was computed by the earlier blocks.
+                        Rows[:,:Start]=Node[:Start,Start:Stop].T
+                    Node[Start:Stop]=Rows
+                del Block
+        finally:
+            if Output=="hdf5":
+                F1.close()
+
+        if Output=="sparse":
+            PairRows=np.concatenate(PairRows+[np.zeros(0,'int')])
+            PairCols=np.concatenate(PairCols+[np.zeros(0,'int')])
+            PairValues=np.concatenate(PairValues+[np.zeros(0,'float32')])
+            Upper=scipy.sparse.coo_matrix((PairValues,(PairRows,PairCols)),shape=(n,n))
+            return((Upper+Upper.T).tocsr())
+        elif Output=="hdf5":
+            return(OutFilename)
+        return(Result)
+    def SaveToLHDF(self,Filename,Precision=1000,Filters=None,ChunkShape=None):
+        """Save a Trajectory instance to a Lossy HDF File.  First, remove the XYZList key because it should be written using the special CArray operation.  This file format is roughly equivalent to an XTC and should comparable file sizes but with better IO performance.  Filters sets the compression (see Serializer.GetFilters) and ChunkShape the chunking of XYZList (a shape, or "frame" / "atom", see Serializer.GetChunkShape)."""
         Serializer.CheckIfFileExists(Filename)
         key="XYZList"
         X=self.pop(key)
-        Serializer.Serializer.SaveToHDF(self,Filename)
+        Serializer.Serializer.SaveToHDF(self,Filename,Filters=Filters)
         Rounded=ConvertToLossyIntegers(X,Precision)
         self[key]=Rounded
-        Serializer.SaveEntryAsCArray(self[key],key,Filename=Filename)
+        Serializer.SaveEntryAsCArray(self[key],key,Filename=Filename,Filters=Filters,ChunkShape=ChunkShape)
         self[key]=X
         
-    def SaveToXTC(self,Filename,Precision=1000):
-        """Take a Trajectory instance and dump the coordinates to XTC"""
+    def SaveToXTC(self,Filename,Precision=1000,Boxes=None,Times=None,Steps=None):
+        """Take a Trajectory instance and dump the coordinates to XTC.  Boxes, Times and Steps give the per-frame box vectors, times and steps (see xtc.XTCWriter.write_block); by default the box is the identity and the times are the frame numbers."""
         Serializer.CheckIfFileExists(Filename)
         XTCFile=xtc.XTCWriter(Filename)
-        for i in range(len(self["XYZList"])):
-            XTCFile.write(self["XYZList"][i],1,i,np.eye(3,3,dtype='float32'),Precision)
+        XTCFile.write_block(self["XYZList"],boxes=Boxes,times=Times,steps=Steps,precision=Precision)
+        del XTCFile
         
-    def SaveToPDB(self,Filename):
-        """Write a conformation as a PDB file."""
-        for i in range(len(self["XYZList"])):
-            PDB.WritePDBConformation(Filename,self["AtomID"], self["AtomNames"],self["ResidueNames"],self["ResidueID"],self["XYZList"][i],self["ChainID"])
-    def Save(self,Filename,Precision=1000):
-        """Auto-detect format and save."""
+    def SaveToPDB(self,Filename,Models=False):
+        """Write the conformations as a PDB file.  Set Models to wrap each frame in MODEL / ENDMDL records."""
+        PDB.WritePDBConformations(Filename,self["AtomID"], self["AtomNames"],self["ResidueNames"],self["ResidueID"],self["XYZList"],self["ChainID"],Models=Models)
+
+    def SaveToGRO(self,Filename,Boxes=None):
+        """Write the conformations as a multi-frame GRO file.  Boxes gives per-frame box vectors (see GRO.WriteGROConformations)."""
+        Serializer.CheckIfFileExists(Filename)
+        GRO.WriteGROConformations(Filename,self["AtomID"],self["AtomNames"],self["ResidueNames"],self["ResidueID"],self["XYZList"],Boxes=Boxes)
+    def Save(self,Filename,Precision=1000,Filters=None,ChunkShape=None):
+        """Auto-detect format and save.  Filters sets the compression of HDF and LHDF files (see Serializer.GetFilters) and ChunkShape the chunking of their coordinates (see Serializer.GetChunkShape)."""
         if ".h5" in Filename:
-            self.SaveToHDF(Filename)
+            self.SaveToHDF(Filename,Filters=Filters,ChunkShapes={"XYZList":ChunkShape})
         elif ".xtc" in Filename:
             self.SaveToXTC(Filename)
         elif ".pdb" in Filename:
             self.SaveToPDB(Filename)
+        elif ".gro" in Filename:
+            self.SaveToGRO(Filename)
         elif ".lh5" in Filename:
-            self.SaveToLHDF(Filename,Precision=Precision)
+            self.SaveToLHDF(Filename,Precision=Precision,Filters=Filters,ChunkShape=ChunkShape)
             
     def AppendPDB(self,Filename):
         try:
@@ -137,80 +365,221 @@ class Trajectory(Conformation.ConformationBaseClass):
         """Create a Trajectory from a PDB Filename."""
         return(Trajectory(PDB.LoadPDB(Filename,AllFrames=True)))
     @classmethod
-    def LoadFromXTC(cls,XTCFilenameList,PDBFilename=None,Conf=None,PreAllocate=True,JustInspect=False):       
-        """Create a Trajectory from a Filename."""
+    def LoadFromXTC(cls,XTCFilenameList,PDBFilename=None,Conf=None,PreAllocate=True,JustInspect=False,Stride=1):       
+        """Create a Trajectory from a Filename.  With Stride=N only every Nth frame is decoded; the frames in between are skipped by seeking.  JustInspect counts frames from the frame headers without decoding any coordinates."""
         if PDBFilename!=None:
             A=Trajectory.LoadFromPDB(PDBFilename)
         elif Conf!=None:
             A=Trajectory(Conf)
         else:
             raise Exception("ERROR: Need a conformation to construct a trajectory.")
+        if isinstance(XTCFilenameList,str):
+            XTCFilenameList=[XTCFilenameList]
+        NumAtoms=xtc.number_of_atoms(XTCFilenameList[0])
         if not JustInspect:
-            A["XYZList"]=[]
-            for c in xtc.XTCReader(XTCFilenameList):
-                A["XYZList"].append(np.array(c.coords).copy())
-            A["XYZList"]=np.array(A["XYZList"])
-        else:
+            if PreAllocate:#The frame indices give an upper bound on the number of frames (continuation frames are skipped).
+                NumFrames=sum([len(LoadXTCFrameIndex(f)) for f in XTCFilenameList])
+                NumFrames=(NumFrames+Stride-1)/Stride
+            else:
+                NumFrames=1024
+            XYZList=np.empty((max(NumFrames,1),NumAtoms,3),dtype='float32')
+            Reader=xtc.XTCReader(XTCFilenameList,stepframe=Stride)
+            Scratch=np.empty((1,NumAtoms,3),dtype='float32')
             i=0
-            for c in xtc.XTCReader(XTCFilenameList):
-                if i==0:
-                    ConfShape=np.shape(c.coords)
-                i=i+1
-            Shape=np.array((i,ConfShape[0],ConfShape[1]))
+            while True:
+                n=Reader.read_block(XYZList[i:])[0]
+                i+=n
+                if i<len(XYZList):
+                    break
+                if Reader.read_block(Scratch)[0]==0:#The buffer is full; only grow it if there really is another frame.
+                    break
+                XYZList.resize((2*len(XYZList),NumAtoms,3),refcheck=False)#Grow geometrically if the frame count was not known (or the file grew).
+                XYZList[i]=Scratch[0]
+                i+=1
+            del Reader
+            XYZList.resize((i,NumAtoms,3),refcheck=False)
+            A["XYZList"]=XYZList
+        else:
+            Counts=[len(LoadXTCFrameIndex(f)) for f in XTCFilenameList]
+            NumFrames=Counts[0]+sum([max(n-1,0) for n in Counts[1:]])#The first frame of each continuation file repeats the last frame of the previous one.
+            Shape=np.array((NumFrames,NumAtoms,3))
             return(Shape)            
         return(A)
     @classmethod
+    def ConvertXTCToLHDF(cls,XTCFilenameList,OutFilename,PDBFilename=None,Conf=None,AtomIndices=None,Precision=1000,ChunkSize=1000,Filters=None,ChunkShape=None):
+        """Convert XTC files to an LHDF file without loading the whole trajectory into memory.
+
+        Inputs:
+        XTCFilenameList: an XTC filename or a list of them (continuation frames are skipped, as in LoadFromXTC).
+        OutFilename: the LHDF file to write.
+
+        Keyword Arguments:
+        PDBFilename, Conf: the topology, as in LoadFromXTC.  If it has fewer atoms than the XTC files (e.g. a solute-only reference for a solvated trajectory), it must describe their first atoms, and only those are written.
+        AtomIndices: only these atoms are written (see GetAtomSelection).  Default: None (all atoms)
+        ChunkSize: the number of frames decoded and written at a time, which bounds memory use.
+        Filters, ChunkShape: compression and chunking of XYZList (see Serializer.GetFilters and Serializer.GetChunkShape).
+
+        Notes:
+        Frames are appended to an int16 EArray; coordinates that do not fit in int16 at this Precision raise an exception and the output file is removed.
+        Coordinates are rounded to the nearest integer.  When every frame was written at this Precision (see CanTranscodeXTCExactly), this reproduces the quantized integers of the XTC exactly, and the int16 range is checked once from the frame headers instead of on every block.
+        """
+        if PDBFilename!=None:
+            A=Trajectory.LoadFromPDB(PDBFilename)
+        elif Conf!=None:
+            A=Trajectory(Conf)
+        else:
+            raise Exception("ERROR: Need a conformation to construct a trajectory.")
+        A.pop("XYZList")
+        if isinstance(XTCFilenameList,str):
+            XTCFilenameList=[XTCFilenameList]
+        XTCNumAtoms=[xtc.number_of_atoms(Filename) for Filename in XTCFilenameList]
+        if len(set(XTCNumAtoms))>1:
+            raise Exception("The XTC files %s have different numbers of atoms: %s"%(XTCFilenameList,XTCNumAtoms))
+        if A.GetNumberOfAtoms()>XTCNumAtoms[0]:
+            raise Exception("The reference has %d atoms, but the XTC files have only %d."%(A.GetNumberOfAtoms(),XTCNumAtoms[0]))
+        ReaderIndices=None
+        if AtomIndices is not None:
+            AtomIndices=np.asarray(AtomIndices)
+            A.RestrictAtomIndices(AtomIndices)
+            ReaderIndices=AtomIndices
+        elif A.GetNumberOfAtoms()<XTCNumAtoms[0]:
+            ReaderIndices=np.arange(A.GetNumberOfAtoms())#The reference covers the first atoms of each frame.
+        NumAtoms=A.GetNumberOfAtoms()
+        Serializer.CheckIfFileExists(OutFilename)
+        Serializer.Serializer.SaveToHDF(A,OutFilename,Filters=Filters)
+        if Filters is None:
+            Filters=Serializer.Filter
+        if isinstance(ChunkShape,str):
+            ChunkShape=Serializer.GetChunkShape((ChunkSize,NumAtoms,3),2,Layout=ChunkShape)
+        CheckRange=not CanTranscodeXTCExactly(XTCFilenameList,Precision)
+        F1=tables.File(OutFilename,'a')
+        try:
+            Node=F1.createEArray("/","XYZList",tables.Int16Atom(),(0,NumAtoms,3),filters=Filters,chunkshape=ChunkShape)
+            Reader=xtc.XTCReader(XTCFilenameList,atomindices=ReaderIndices)
+            Block=np.empty((ChunkSize,NumAtoms,3),dtype='float32')
+            n=ChunkSize
+            while n==ChunkSize:
+                n=Reader.read_block(Block)[0]
+                X=Block[:n]
+                X*=float(Precision)
+                if CheckRange and n>0 and (X.max()>=MAXINT16 or X.min()<=-MAXINT16):
+                    raise Exception("Coordinates in %s are too large for int16 at precision %s: try removing center of mass motion, or use .h5 format."%(XTCFilenameList,Precision))
+                np.rint(X,out=X)
+                Node.append(X.astype("int16"))
+            del Reader
+        except:
+            F1.close()
+            os.remove(OutFilename)
+            raise
+        F1.close()
+    @classmethod
 
     def LoadFromDCD(cls,FilenameList,PDBFilename=None,Conf=None,PreAllocate=True,JustInspect=False):       
-        """Create a Trajectory from a Filename."""
+        """Create a Trajectory from a Filename.  DCD files with fixed-size frames are read through a memory map (see dcd.dcd_memmap); others are decoded by the molfile plugin into a preallocated single precision array."""
         if PDBFilename!=None:
             A=Trajectory.LoadFromPDB(PDBFilename)
         elif Conf!=None:
             A=Trajectory(Conf)
         else:
             raise Exception("ERROR: Need a conformation to construct a trajectory.")
-        if not JustInspect:
-            A["XYZList"]=[]
-            for c in dcd.DCDReader(FilenameList):
-                A["XYZList"].append(c.copy())
-            A["XYZList"]=np.array(A["XYZList"])
-        else: #This is wasteful to read everything in just to get the length
-            XYZ=[]
-            for c in dcd.DCDReader(FilenameList):
-                XYZ.append(c.copy())
-            XYZ=np.array(XYZ)
-            return(XYZ.shape)
+        if isinstance(FilenameList,str):
+            FilenameList=[FilenameList]
+        try:
+            Headers=[dcd.dcd_header(f) for f in FilenameList]
+            if None in [H["dtype"] for H in Headers]:
+                Headers=None
+        except IOError:
+            Headers=None
 
+        if Headers!=None:#The first frame of each continuation file repeats the last frame of the previous one.
+            NumAtoms=Headers[0]["natoms"]
+            Counts=[Headers[0]["nframes"]]+[max(H["nframes"]-1,0) for H in Headers[1:]]
+            if JustInspect:
+                return((sum(Counts),NumAtoms,3))
+            XYZList=np.empty((sum(Counts),NumAtoms,3),dtype='float32')
+            Current=0
+            for k,f in enumerate(FilenameList):
+                dcd.read_dcd_memmap(f,slice(Headers[k]["nframes"]-Counts[k],None),XYZList[Current:Current+Counts[k]])
+                Current+=Counts[k]
+            A["XYZList"]=XYZList
+            return(A)
+
+        Reader=dcd.DCDReader(FilenameList)
+        NumAtoms=Reader.natoms.value
+        XYZList=np.empty((1024,NumAtoms,3),dtype='float32')
+        i=0
+        if JustInspect:#Count frames without keeping them.
+            n=len(XYZList)
+            while n==len(XYZList):
+                n=Reader.read_block(XYZList)
+                i+=n
+            return((i,NumAtoms,3))
+        while True:
+            i+=Reader.read_block(XYZList[i:])
+            if i<len(XYZList):
+                break
+            XYZList.resize((2*len(XYZList),NumAtoms,3),refcheck=False)
+        del Reader
+        XYZList.resize((i,NumAtoms,3),refcheck=False)
+        A["XYZList"]=XYZList
         return(A)
 
     @classmethod
-    def LoadFromTRR(cls,TRRFilenameList,PDBFilename=None,Conf=None,PreAllocate=True,JustInspect=False):       
-        """Create a Trajectory with title Title from a Filename."""
+    def LoadFromTRR(cls,TRRFilenameList,PDBFilename=None,Conf=None,PreAllocate=True,JustInspect=False,Fields=("XYZList","Velocities","Forces"),Frames=None):       
+        """Create a Trajectory from a list of TRR files.
+
+        Keyword Arguments:
+        Fields -- Which of "XYZList", "Velocities", "Forces" and "Boxes" to load.  Default: coordinates, velocities and forces
+        Frames -- Which frames to load, numbered across all the files (without the repeated first frame of each continuation file).  Default: None (all frames)
+
+        Notes:
+        The frame headers are indexed first (see xtc.scan_trr_headers), and then only the requested fields of the requested frames are read.  Fields that a frame does not contain are filled with nan.
+        """
+        if isinstance(TRRFilenameList,str):
+            TRRFilenameList=[TRRFilenameList]
+        Indices=[xtc.scan_trr_headers(Filename) for Filename in TRRFilenameList]
+        Indices=Indices[:1]+[Index[1:] for Index in Indices[1:]]#The first frame of each continuation file repeats the last frame of the previous one.
+        Lengths=np.array([len(Index) for Index in Indices],'int')
+        if JustInspect:
+            NumAtoms=[Index["natoms"][0] for Index in Indices if len(Index)>0]
+            return(np.array((Lengths.sum(),NumAtoms[0] if NumAtoms else 0,3)))
+
         if PDBFilename!=None:
             A=Trajectory.LoadFromPDB(PDBFilename)
         elif Conf!=None:
             A=Trajectory(Conf)
         else:
             raise Exception("ERROR: Need a conformation to construct a trajectory.")
-        if not JustInspect:
-            A["XYZList"]=[]
-            A["Velocities"]=[]
-            A["Forces"]=[]
-            for c in xtc.TRRReader(TRRFilenameList):
-                A["XYZList"].append(np.array(c.coords).copy())
-                A["Velocities"].append(np.array(c.velocities).copy())
-                A["Forces"].append(np.array(c.forces).copy())
-            A["XYZList"]=np.array(A["XYZList"])
-            A["Velocities"]=np.array(A["Velocities"])
-            A["Forces"]=np.array(A["Forces"])
-        else:
-            i=0
-            for c in xtc.TRRReader(TRRFilenameList):
-                if i==0:
-                    ConfShape=np.shape(c.coords)
-                i=i+1
-            Shape=np.array((i,ConfShape[0],ConfShape[1]))
-            return(Shape)            
+        FieldNames={"XYZList":"x","Velocities":"v","Forces":"f","Boxes":"box"}
+        for key in Fields:
+            if key not in FieldNames:
+                raise Exception("Unknown TRR field %s; choose from %s"%(key,FieldNames.keys()))
+        if Frames is None:
+            Frames=np.arange(Lengths.sum())
+        Frames=np.asarray(Frames,'int').reshape(-1)
+        if len(Frames)>0 and (Frames.min()<0 or Frames.max()>=Lengths.sum()):
+            raise Exception("Frames must lie between 0 and %d"%(Lengths.sum()-1))
+        Starts=np.concatenate(([0],np.cumsum(Lengths)))
+        FileNumbers=np.searchsorted(Starts,Frames,side="right")-1
+
+        Parts=dict((key,[]) for key in Fields)
+        Order=[]
+        for i,Filename in enumerate(TRRFilenameList):
+            Which=np.where(FileNumbers==i)[0]
+            if len(Which)==0:
+                continue
+            Data=xtc.read_trr_fields(Filename,fields=[FieldNames[key] for key in Fields],frames=Frames[Which]-Starts[i],index=Indices[i])
+            for key in Fields:
+                Parts[key].append(Data[FieldNames[key]])
+            Order.append(Which)
+        Order=np.argsort(np.concatenate(Order+[np.zeros(0,'int')]))#Put the frames back in the requested order
+        for key in Fields:
+            if len(Parts[key])>0:
+                A[key]=np.concatenate(Parts[key])[Order]
+            elif key=="Boxes":
+                A[key]=np.zeros((0,3,3),'float32')
+            else:
+                A[key]=np.zeros((0,A.GetNumberOfAtoms(),3),'float32')
         return(A)
     @classmethod
     def LoadFromPDBList(cls,Filenames):       
@@ -234,8 +603,13 @@ class Trajectory(Conformation.ConformationBaseClass):
             return(Shape)        
     @classmethod
     def LoadFromLHDF(cls,Filename,JustInspect=False,Precision=1000):
-        """Load a conformation that was previously saved as HDF."""
+        """Load a conformation that was previously saved as HDF.  If the trajectory has an up to date coordinate sidecar (see WriteCoordinateSidecar), XYZList is a copy-on-write memory map of it."""
         if not JustInspect:
+            XYZList=LoadCoordinateSidecar(Filename)
+            if XYZList is not None:
+                A=cls.LoadTopologyFromHDF(Filename)
+                A["XYZList"]=XYZList
+                return(A)
             S=Serializer.Serializer.LoadFromHDF(Filename)
             A=cls(S)
             A["XYZList"]=ConvertFromLossyIntegers(A["XYZList"],Precision)
@@ -246,39 +620,76 @@ class Trajectory(Conformation.ConformationBaseClass):
             F1.close()
             return(Shape)
     @classmethod
+    def LoadTopologyFromHDF(cls,Filename):
+        """Load the atom and residue tables of an HDF or LHDF trajectory without reading its coordinate data.  The XYZList key is left as an empty list."""
+        S=Serializer.Serializer.LoadFromHDF(Filename,SkipKeys=["XYZList"])
+        return(cls(S))
+    @classmethod
     def ReadXTCFrame(cls,TrajFilename,WhichFrame):
-        """Read a single frame from XTC trajectory file without loading file into memory."""
-        i=0
-        for c in xtc.XTCReader(TrajFilename):
-            if i == WhichFrame:
-                return(np.array(c.coords))
-            i = i+1
-        raise Exception("Frame %d not found in file %s; last frame found was %d"%(WhichFrame,cls.TrajFilename,i))
+        """Read a single frame from XTC trajectory file without loading file into memory.  Uses the cached frame index (see LoadXTCFrameIndex) to seek straight to the frame."""
+        Offsets=LoadXTCFrameIndex(TrajFilename)
+        if WhichFrame>=len(Offsets):
+            raise Exception("Frame %d not found in file %s; last frame found was %d"%(WhichFrame,TrajFilename,len(Offsets)-1))
+        return(xtc.read_xtc_frame(TrajFilename,Offsets[WhichFrame]))
     @classmethod
-    def ReadHDF5Frame(cls,TrajFilename,WhichFrame):
-        """Read a single frame from HDF5 trajectory file without loading file into memory."""
-        F1=tables.File(TrajFilename)
-        XYZ=F1.root.XYZList[WhichFrame]
-        F1.close()
-        return(XYZ)
+    def ReadHDF5Frame(cls,TrajFilename,WhichFrame,FilePool=None):
+        """Read a single frame from HDF5 trajectory file without loading file into memory.  If a Serializer.HDF5FilePool is given, the file is taken from (and left open in) the pool."""
+        return(Trajectory.ReadHDF5Frames(TrajFilename,[WhichFrame],FilePool=FilePool)[0])
     @classmethod
-    def ReadLHDF5Frame(cls,TrajFilename,WhichFrame,Precision=1000.):
+    def ReadLHDF5Frame(cls,TrajFilename,WhichFrame,Precision=1000.,FilePool=None):
         """Read a single frame from Lossy LHDF5 trajectory file without loading file into memory."""
-        F1=tables.File(TrajFilename)
-        XYZ=F1.root.XYZList[WhichFrame]
-        F1.close()
+        XYZList=LoadCoordinateSidecar(TrajFilename)
+        if XYZList is not None:
+            return(np.array(XYZList[WhichFrame]))
+        XYZ=Trajectory.ReadHDF5Frames(TrajFilename,[WhichFrame],FilePool=FilePool)[0]
         XYZ=ConvertFromLossyIntegers(XYZ,Precision)
         return(XYZ)
     @classmethod
-    def ReadFrame(cls,TrajFilename,WhichFrame,Conf=None):
+    def ReadHDF5Frames(cls,TrajFilename,WhichFrames,FilePool=None):
+        """Read the frames WhichFrames (an ascending array without duplicates) from an HDF5 trajectory file.  Runs of consecutive frames are read as a single slice."""
+        WhichFrames=np.array(WhichFrames,dtype='int').reshape((-1,))
+        if FilePool==None:
+            F1=tables.File(TrajFilename,'r')
+        else:
+            F1=FilePool.GetFile(TrajFilename)
+        try:
+            Starts=np.concatenate(([0],np.where(np.diff(WhichFrames)!=1)[0]+1))
+            Stops=np.concatenate((Starts[1:],[len(WhichFrames)]))
+            XYZ=[F1.root.XYZList[WhichFrames[a]:WhichFrames[b-1]+1] for a,b in zip(Starts,Stops)]
+        finally:
+            if FilePool==None:
+                F1.close()
+        return(np.concatenate(XYZ))
+    @classmethod
+    def ReadFrame(cls,TrajFilename,WhichFrame,Conf=None,FilePool=None):
         if "xtc" in TrajFilename:
             return(Trajectory.ReadXTCFrame(TrajFilename,WhichFrame))
         elif ".h5" in TrajFilename:
-            return(Trajectory.ReadHDF5Frame(TrajFilename,WhichFrame))
+            return(Trajectory.ReadHDF5Frame(TrajFilename,WhichFrame,FilePool=FilePool))
+        elif ".lh5" in TrajFilename:
+            return(Trajectory.ReadLHDF5Frame(TrajFilename,WhichFrame,FilePool=FilePool))
+        else:
+            raise Exception("Incorrect file type--cannot get conformation %s"%TrajFilename)
+    @classmethod
+    def ReadFrames(cls,TrajFilename,WhichFrames,Conf=None,FilePool=None,Precision=1000.):
+        """Read several frames of a single trajectory file, returned in the order given by WhichFrames.  The frames are read in ascending order, so access to the file is sequential, and each distinct frame is decoded once."""
+        WhichFrames=np.array(WhichFrames,dtype='int').reshape((-1,))
+        Unique,Inverse=np.unique(WhichFrames,return_inverse=True)
+        if "xtc" in TrajFilename:
+            Offsets=LoadXTCFrameIndex(TrajFilename)
+            if len(Unique)>0 and Unique[-1]>=len(Offsets):
+                raise Exception("Frame %d not found in file %s; last frame found was %d"%(Unique[-1],TrajFilename,len(Offsets)-1))
+            XYZ=xtc.read_xtc_frames(TrajFilename,Offsets[Unique])
+        elif ".h5" in TrajFilename:
+            XYZ=Trajectory.ReadHDF5Frames(TrajFilename,Unique,FilePool=FilePool)
         elif ".lh5" in TrajFilename:
-            return(Trajectory.ReadLHDF5Frame(TrajFilename,WhichFrame))
+            XYZList=LoadCoordinateSidecar(TrajFilename)
+            if XYZList is not None:
+                return(np.asarray(XYZList[WhichFrames]))
+            XYZ=ConvertFromLossyIntegers(Trajectory.ReadHDF5Frames(TrajFilename,Unique,FilePool=FilePool),Precision)
         else:
             raise Exception("Incorrect file type--cannot get conformation %s"%TrajFilename)
+        return(XYZ[Inverse])
     @classmethod
     def LoadTrajectoryFile(cls,Filename,JustInspect=False,Conf=None):
         """Loads a trajectory into memory, automatically deciding which methods to call based on filetype.  For XTC files, this method uses a pre-registered Conformation filename as a pdb."""
@@ -294,3 +705,14 @@ class Trajectory(Conformation.ConformationBaseClass):
             return(Trajectory.LoadFromDCD(Filename,Conf=Conf,JustInspect=JustInspect))
         elif ".lh5" in Filename:
             return(Trajectory.LoadFromLHDF(Filename,JustInspect=JustInspect))
+    @classmethod
+    def LoadTrajectoryTopology(cls,Filename,Conf=None):
+        """Create a Trajectory with the atoms and residues of a trajectory file but no coordinate data.  HDF and LHDF files are read without touching their coordinates; XTC and DCD files take their topology from the registered Conformation."""
+        if ".h5" in Filename or ".lh5" in Filename:
+            return(Trajectory.LoadTopologyFromHDF(Filename))
+        elif ".xtc" in Filename or ".dcd" in Filename:
+            if Conf==None:
+                raise Exception("Need to register a Conformation to get the topology of %s."%Filename)
+            return(Trajectory(Conf))
+        else:
+            raise Exception("Incorrect file type--cannot get topology of %s"%Filename)
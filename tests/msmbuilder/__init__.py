@@ -35,6 +35,7 @@ __all__ = [
 "CopernicusProject",
 "CreateMergedTrajectoriesFromFAH",
 "DistanceMetric", 
+"GRO",
 "MSMLib", 
 "PDB", 
 "PlotGraph", 
@@ -31,6 +31,7 @@ from ctypes.util import find_library
 import os.path
 import sys
 import imp
+import struct
 
 # define handle to dcd library as global variable (but it should only be used within this module)
 _dcdlib = None
@@ -95,6 +96,83 @@ def loadDCDLibrary(LoadDirectFromMSMBuilder=True):
 
 
 
+def dcd_header(filename):
+    """Parses the header of a CHARMM/NAMD/X-PLOR dcd file without the molfile plugin.
+
+    Returns a dictionary with the number of atoms ("natoms"), the size of the header in bytes
+    ("headersize"), the number of complete frames in the file ("nframes") and a numpy record
+    dtype describing one frame ("dtype", with fields "x", "y" and "z" and, if present, "cell"
+    and "w").  If the file has fixed atoms its frames differ in size and "dtype" is None.
+    """
+    filename = str(filename)
+    filesize = os.path.getsize(filename)
+    f = open(filename, "rb")
+    try:
+        head = f.read(92)
+        if len(head) < 92:
+            raise IOError("File " + filename + " is too short to be a dcd file.")
+        if struct.unpack("<i", head[:4])[0] == 84:
+            endian = "<"
+        elif struct.unpack(">i", head[:4])[0] == 84:
+            endian = ">"
+        else:
+            raise IOError("File " + filename + " is not a dcd file.")
+        if head[4:8] != "CORD":
+            raise IOError("File " + filename + " is not a dcd coordinate file.")
+        icntrl = struct.unpack(endian + "20i", head[8:88])
+        charmm = icntrl[19] != 0
+        namnf = icntrl[8]
+        hascell = charmm and icntrl[10] != 0
+        has4d = charmm and icntrl[11] != 0
+        titlesize = struct.unpack(endian + "i", f.read(4))[0]
+        f.seek(titlesize + 4, 1)
+        natoms = struct.unpack(endian + "3i", f.read(12))[1]
+        headersize = f.tell()
+        if namnf > 0:
+            headersize += 8 + 4 * (natoms - namnf)
+    finally:
+        f.close()
+
+    if namnf > 0:
+        dtype = None
+        nframes = None
+    else:
+        fields = []
+        if hascell:
+            fields += [("cellhead", endian + "i4"), ("cell", endian + "f8", (6,)), ("celltail", endian + "i4")]
+        for axis in (["x", "y", "z", "w"] if has4d else ["x", "y", "z"]):
+            fields += [(axis + "head", endian + "i4"), (axis, endian + "f4", (natoms,)), (axis + "tail", endian + "i4")]
+        dtype = np.dtype(fields)
+        nframes = (filesize - headersize) // dtype.itemsize
+    return {"natoms": natoms, "headersize": headersize, "nframes": nframes, "dtype": dtype}
+
+def dcd_memmap(filename):
+    """Returns a read-only memory map of the frame records of a dcd file (see dcd_header).
+
+    Frame i starts at byte headersize + i * dtype.itemsize, so any frame can be reached without
+    reading the ones before it.  Coordinates are in Angstrom, as stored in the file.
+    """
+    header = dcd_header(filename)
+    if header["dtype"] is None:
+        raise IOError("Dcd file " + str(filename) + " has fixed atoms, so its frames cannot be memory mapped.")
+    return np.memmap(str(filename), dtype=header["dtype"], mode="r", offset=header["headersize"], shape=(header["nframes"],))
+
+def read_dcd_memmap(filename, frames=None, coords=None):
+    """Returns the coordinates (in nm) of the selected frames of a dcd file as an (N,natoms,3) float32 array.
+
+    frames is anything that can index an array of frames (default: all frames).  The coordinates
+    are written into coords if it is given.
+    """
+    records = dcd_memmap(filename)
+    if frames is not None:
+        records = records[frames]
+    if coords is None:
+        coords = np.empty([len(records), records.dtype["x"].shape[0], 3], dtype='single')
+    for k, axis in enumerate("xyz"):
+        coords[:, :, k] = records[axis]
+    coords *= 0.1       # \AA -> nm
+    return coords
+
 class DCDReader:
     """Object that allows iteration over the configurations in a dcd trajectory file.
 
@@ -170,10 +248,9 @@ class DCDReader:
     def __iter__(self):
         return self
 
-    def next(self):
-        Coords=c_float * (self.natoms.value * 3)
-        xyzvec=Coords()
-        self._ts.coords=xyzvec
+    def _read_into(self, coords):
+        """Decodes frames until the next requested frame has been read into coords, a C-contiguous (natoms,3) float32 array (in Angstrom)."""
+        self._ts.coords=coords.ctypes.data_as(POINTER(c_float))
 
         while self._frame < self._nextframe:
             if self._lastframe != None and self._frame >= self._lastframe:
@@ -195,20 +272,47 @@ class DCDReader:
             else:
                 raise IOError("An error occured while reading dcd file.")
 
-        # now generate the structure that will be returned to caller
-           # config=Configuration(self._step.value,self._time.value,
-           #       self._precision.value,self._box,self._allcoords,self._atomindices)
-
         self._nextframe += self._stepframe
 
-        # create a "coords" numpy array for returning
-        coords=np.asfarray(np.array(xyzvec).reshape(self.natoms.value,3))
+    def next(self):
+        # decode straight into a new single precision array, which is returned to the caller
+        coords=np.empty([self.natoms.value,3],dtype='single')
+        self._read_into(coords)
         if self._atomindices != None:
             coords=coords[self._atomindices,]
-        coords=coords*0.1       # \AA -> nm
-#        print coords
+        coords*=0.1       # \AA -> nm
         return coords
 
+    def read_block(self, coords):
+        """Decodes up to len(coords) frames (in nm) into coords, a caller-supplied (N,natoms,3) float32 array (or (N,len(atomindices),3) if atomindices were given).
+
+        Returns the number of frames read, which is less than N only at the end of the trajectory.
+        Without atomindices, frames are decoded straight into coords.
+        """
+        if coords.dtype != np.float32 or not coords.flags.c_contiguous:
+            raise TypeError("read_block needs a C-contiguous float32 array.")
+        if self._atomindices is not None:
+            width = len(self._atomindices)
+        else:
+            width = self.natoms.value
+        if coords.ndim != 3 or coords.shape[1:] != (width, 3):
+            raise ValueError("read_block needs an array of shape (N,%d,3), not %s." % (width, str(coords.shape)))
+        if self._atomindices is not None:
+            allcoords=np.empty([self.natoms.value,3],dtype='single')
+        i = 0
+        try:
+            while i < len(coords):
+                if self._atomindices is None:
+                    self._read_into(coords[i])
+                else:
+                    self._read_into(allcoords)
+                    coords[i]=allcoords[self._atomindices]
+                i += 1
+        except StopIteration:
+            pass
+        coords[:i]*=0.1       # \AA -> nm
+        return i
+
 
 
 
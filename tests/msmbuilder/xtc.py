@@ -30,9 +30,11 @@ from ctypes.util import find_library
 import os.path
 import sys
 import imp
+import struct
 
 # define handle to xdr library as global variable (but it should only be used within this module)
 _xdrlib = None
+_write_xtc_unchecked = None
 
 # return codes of xdr library (defined in xdrfile.h, descriptions in xdrfile.c)
 _EXDROK = 0             # OK
@@ -49,9 +51,23 @@ _EXDRNOMEM = 10         # Not enough memory
 _EXDRENDOFFILE = 11     # End of file
 _EXDRFILENOTFOUND = 12  # File not found
 
+# layout of an xtc frame (all values are big-endian xdr words)
+_XTC_MAGIC = 1995
+_XTC_SMALL_HEADER = 56  # magic, natoms, step, time, box, natoms
+_XTC_HEADER = 92        # ... precision, minint, maxint, smallidx, byte count
+_TRR_MAGIC = 1993
+_TRR_FIELDS = ("box", "x", "v", "f")
+
+# one entry per trr frame: header values and the byte offset of each field (-1 if the frame does not contain it)
+trr_index_dtype = np.dtype([("offset", "int64"), ("natoms", "int32"), ("step", "int32"), ("time", "float64"), ("lambda", "float64"), ("realsize", "int32"),
+                            ("box", "int64"), ("x", "int64"), ("v", "int64"), ("f", "int64")])
+
+_libc = CDLL(find_library("c"))
+_libc.fseek.argtypes = [c_void_p, c_long, c_int]
+
 
 def loadXDRLibrary(LoadDirectFromMSMBuilder=True):
-    global _xdrlib
+    global _xdrlib, _write_xtc_unchecked
 
     xdr_library_path = find_library("xdrfile")
     if xdr_library_path and not LoadDirectFromMSMBuilder:
@@ -80,7 +96,22 @@ def loadXDRLibrary(LoadDirectFromMSMBuilder=True):
     _xdrlib.read_xtc.argtypes = [c_void_p, c_int, POINTER(c_int), POINTER(c_float), ndpointer(dtype="single",shape=(3,3),flags="C_CONTIGUOUS"), ndpointer(dtype="single",ndim=2,flags="C_CONTIGUOUS"), POINTER(c_float)]
     _xdrlib.read_trr.argtypes = [c_void_p, c_int, POINTER(c_int), POINTER(c_float),POINTER(c_float), ndpointer(dtype="single",shape=(3,3),flags="C_CONTIGUOUS"), ndpointer(dtype="single",ndim=2,flags="C_CONTIGUOUS"),ndpointer(dtype="single",ndim=2,flags="C_CONTIGUOUS"),ndpointer(dtype="single",ndim=2,flags="C_CONTIGUOUS")]
     _xdrlib.write_xtc.argtypes = [c_void_p, c_int, c_int, c_float, ndpointer(dtype="single",shape=(3,3),flags="C_CONTIGUOUS"), ndpointer(dtype="single",ndim=2,flags="C_CONTIGUOUS"), c_float]
-    
+    # a second handle on write_xtc that takes raw addresses; XTCWriter.write_block checks the whole block once instead of every frame
+    _write_xtc_unchecked = _xdrlib["write_xtc"]
+    _write_xtc_unchecked.argtypes = [c_void_p, c_int, c_int, c_float, c_void_p, c_void_p, c_float]
+    if hasattr(_xdrlib, "xdr_seek"):
+        _xdrlib.xdr_seek.argtypes = [c_void_p, c_int64, c_int]
+
+def _xdr_seek(xdr, offset):
+    """Moves the read position of an open xdr file to the given byte offset."""
+    if hasattr(_xdrlib, "xdr_seek"):
+        result = _xdrlib.xdr_seek(xdr, offset, 0)
+    else:
+        # older xdrfile libraries have no seek function, but the FILE pointer is the first member of the XDRFILE structure
+        result = _libc.fseek(cast(xdr, POINTER(c_void_p))[0], offset, 0)
+    if result != 0:
+        raise IOError("Unable to seek to byte " + str(offset) + " of xtc file.")
+
 def number_of_atoms(filename):
     """Returns the number of atoms in specified xtc file."""
     n = c_int()
@@ -95,6 +126,183 @@ def number_of_atoms_trr(filename):
         raise IOError("Unable to determine number of atoms in file " + str(filename) + ".")
     return int(n.value)
 
+def xtc_frame_offsets(filename):
+    """Returns an array with the byte offset of every frame in the specified xtc file.
+
+    Only the frame headers are read (see scan_xtc_headers).
+    """
+    return scan_xtc_headers(filename)[0]
+
+def scan_xtc_headers(filename, quantization=False):
+    """Returns arrays with the byte offset, step and time of every frame in the specified xtc file.
+
+    Only the frame headers are read: the compressed coordinates of each frame are skipped
+    using the byte count stored in its header, so this is a cheap way to count frames. A
+    truncated last frame (e.g. of a running simulation) is ignored.
+
+    With quantization=True, three more arrays are returned: the precision of each frame and the
+    smallest and largest quantized integer coordinates (minint, maxint) on each axis. Frames of
+    9 atoms or fewer are stored uncompressed and have precision nan.
+    """
+    filename = str(filename)
+    filesize = os.path.getsize(filename)
+    offsets = []
+    steps = []
+    times = []
+    precisions = []
+    minints = []
+    maxints = []
+    f = open(filename, "rb")
+    try:
+        offset = 0
+        while offset + _XTC_SMALL_HEADER <= filesize:
+            f.seek(offset)
+            header = f.read(_XTC_HEADER)
+            magic, natoms, step, time = struct.unpack(">iiif", header[:16])
+            if magic != _XTC_MAGIC:
+                raise IOError("Bad magic number at byte " + str(offset) + " of xtc file " + filename + ".")
+            if natoms <= 9:
+                framesize = _XTC_SMALL_HEADER + 12 * natoms
+                quantized = (np.nan, (0, 0, 0), (0, 0, 0))
+            elif len(header) < _XTC_HEADER:
+                break
+            else:
+                nbytes = struct.unpack(">i", header[88:92])[0]
+                framesize = _XTC_HEADER + 4 * ((nbytes + 3) // 4)
+                quantized = (struct.unpack(">f", header[56:60])[0], struct.unpack(">3i", header[60:72]), struct.unpack(">3i", header[72:84]))
+            if offset + framesize > filesize:
+                break
+            offsets.append(offset)
+            steps.append(step)
+            times.append(time)
+            precisions.append(quantized[0])
+            minints.append(quantized[1])
+            maxints.append(quantized[2])
+            offset += framesize
+    finally:
+        f.close()
+    if quantization:
+        return (np.array(offsets, dtype="int64"), np.array(steps, dtype="int32"), np.array(times, dtype="single"),
+                np.array(precisions, dtype="single"), np.array(minints, dtype="int32").reshape((-1, 3)), np.array(maxints, dtype="int32").reshape((-1, 3)))
+    return np.array(offsets, dtype="int64"), np.array(steps, dtype="int32"), np.array(times, dtype="single")
+
+def read_xtc_frame(filename, offset, natoms=None):
+    """Returns the coordinates of the frame that starts at the given byte offset of an xtc file.
+
+    Use xtc_frame_offsets to find the offsets; the frames before it are not decoded.
+    """
+    return read_xtc_frames(filename, [offset], natoms)[0]
+
+def read_xtc_frames(filename, offsets, natoms=None):
+    """Returns an array with the coordinates of the frames that start at the given byte offsets of an xtc file.
+
+    The file is opened once; pass the offsets in ascending order to read it sequentially.
+    """
+    filename = str(filename)
+    if natoms is None:
+        natoms = number_of_atoms(filename)
+    coords = np.empty([len(offsets),natoms,3],dtype='single',order='C')
+    box = np.empty([3,3],dtype='single',order='C')
+    step = c_int()
+    time = c_float()
+    precision = c_float()
+    xdr = _xdrlib.xdrfile_open(filename, "r")
+    if not xdr:
+        raise IOError("Unable to open xtc file " + filename + ".")
+    try:
+        for i, offset in enumerate(offsets):
+            _xdr_seek(xdr, int(offset))
+            if _xdrlib.read_xtc(xdr, natoms, byref(step), byref(time), box, coords[i], byref(precision)) != _EXDROK:
+                raise IOError("An error occured while reading xtc file.")
+    finally:
+        _xdrlib.xdrfile_close(xdr)
+    return coords
+
+def scan_trr_headers(filename):
+    """Returns a record array (see trr_index_dtype) describing every frame of the specified trr file.
+
+    Only the frame headers are read: single and double precision files are told apart from
+    the field sizes, and the data of each frame is skipped. A truncated last frame is ignored.
+    """
+    filename = str(filename)
+    filesize = os.path.getsize(filename)
+    records = []
+    f = open(filename, "rb")
+    try:
+        offset = 0
+        while offset + 12 <= filesize:
+            f.seek(offset)
+            magic, slen, nchars = struct.unpack(">iii", f.read(12))
+            if magic != _TRR_MAGIC:
+                raise IOError("Bad magic number at byte " + str(offset) + " of trr file " + filename + ".")
+            pos = offset + 12 + 4 * ((nchars + 3) // 4)
+            f.seek(pos)
+            sizes = f.read(52)
+            if len(sizes) < 52:
+                break
+            ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size, x_size, v_size, f_size, natoms, step, nre = struct.unpack(">13i", sizes)
+            if box_size:
+                realsize = box_size // 9
+            elif natoms and (x_size or v_size or f_size):
+                realsize = max(x_size, v_size, f_size) // (3 * natoms)
+            else:
+                realsize = 4
+            if realsize not in (4, 8):
+                raise IOError("Unable to tell the precision of the frame at byte " + str(offset) + " of trr file " + filename + ".")
+            reals = f.read(2 * realsize)
+            if len(reals) < 2 * realsize:
+                break
+            time, lam = struct.unpack(">dd" if realsize == 8 else ">ff", reals)
+            pos += 52 + 2 * realsize + ir_size + e_size
+            fieldoffsets = {}
+            for name, size in (("box", box_size), ("vir", vir_size), ("pres", pres_size), ("top", top_size), ("sym", sym_size), ("x", x_size), ("v", v_size), ("f", f_size)):
+                fieldoffsets[name] = pos if size else -1
+                pos += size
+            if pos > filesize:
+                break
+            records.append((offset, natoms, step, time, lam, realsize) + tuple(fieldoffsets[name] for name in _TRR_FIELDS))
+            offset = pos
+    finally:
+        f.close()
+    return np.array(records, dtype=trr_index_dtype)
+
+def read_trr_fields(filename, fields=("x", "v", "f"), frames=None, index=None):
+    """Returns a dictionary with the requested fields ("box", "x", "v" and/or "f") of the given frames of a trr file.
+
+    Each field is a single precision array of shape (frames, natoms, 3), or (frames, 3, 3) for the box.
+    Only the requested data is read, seeking straight to it with the frame index (see scan_trr_headers,
+    or pass a precomputed index). Frames that do not contain a field are filled with nan.
+    """
+    filename = str(filename)
+    if index is None:
+        index = scan_trr_headers(filename)
+    if frames is None:
+        frames = np.arange(len(index))
+    frames = np.asarray(frames, dtype="int64").reshape(-1)
+    for name in fields:
+        if name not in _TRR_FIELDS:
+            raise ValueError("Unknown trr field " + str(name) + "; choose from " + str(_TRR_FIELDS) + ".")
+    natoms = int(index["natoms"][0]) if len(index) else 0
+    result = {}
+    for name in fields:
+        shape = (3, 3) if name == "box" else (natoms, 3)
+        result[name] = np.empty((len(frames),) + shape, dtype="single")
+    f = open(filename, "rb")
+    try:
+        for i, frame in enumerate(frames):
+            entry = index[frame]
+            dtype = ">f8" if entry["realsize"] == 8 else ">f4"
+            for name in fields:
+                if entry[name] < 0:
+                    result[name][i] = np.nan
+                    continue
+                f.seek(int(entry[name]))
+                data = np.fromfile(f, dtype=dtype, count=result[name][i].size)
+                result[name][i] = data.reshape(result[name][i].shape)
+    finally:
+        f.close()
+    return result
+
 class XTCWriter:
     def __init__(self, filename, overwrite = False):
         filename = str(filename)
@@ -119,6 +327,42 @@ class XTCWriter:
         else:
             raise IOError("Trying to write to xtc file that has not been opened.")
 
+    def write_block(self, coords, boxes=None, times=None, steps=None, precision=1000.):
+        """Write a (frames, atoms, 3) block of coordinates in one call.
+
+        boxes can be a single 3x3 box, per-frame 3x3 boxes, or per-frame box lengths (frames, 3); the default is an identity box.
+        A (3, 3) array is always read as a single box, so for 3 frames pass box lengths as (3, 3, 3) boxes.
+        times and steps default to the frame numbers.  Returns the number of frames written.
+        """
+        if not self.xdr:
+            raise IOError("Trying to write to xtc file that has not been opened.")
+        coords = np.ascontiguousarray(coords, dtype="single")
+        if coords.ndim != 3 or coords.shape[2] != 3:
+            raise ValueError("coords must have shape (frames, atoms, 3), not " + str(coords.shape) + ".")
+        n, natoms = coords.shape[0], coords.shape[1]
+        if boxes is None:
+            boxes = np.eye(3, 3, dtype="single")
+        boxes = np.asarray(boxes, dtype="single")
+        # a single 3x3 box is used for every frame, even when there are exactly 3 frames
+        if boxes.shape != (3, 3) and boxes.shape == (n, 3):
+            boxes = boxes[:, :, np.newaxis] * np.eye(3, 3, dtype="single")
+        boxes = np.ascontiguousarray(np.broadcast_to(boxes, (n, 3, 3)), dtype="single")
+        if times is None:
+            times = np.arange(n)
+        if steps is None:
+            steps = np.arange(n)
+        times = np.asarray(times, dtype="float64")
+        steps = np.asarray(steps, dtype="int64")
+        if len(times) != n or len(steps) != n:
+            raise ValueError("times and steps must have one entry per frame.")
+        address = coords.ctypes.data
+        boxaddress = boxes.ctypes.data
+        framebytes = coords.strides[0]
+        for i in xrange(n):
+            if _write_xtc_unchecked(self.xdr, natoms, int(steps[i]), float(times[i]), boxaddress + 36 * i, address + framebytes * i, precision) != _EXDROK:
+                raise IOError("An error occured while writing to xtc file.")
+        return n
+
 class Configuration:
     """Structure containing a single frame from a xtc file.    
     Elements:
@@ -132,7 +376,7 @@ class Configuration:
         self.time=time
         self.precision=precision
         self.box=box
-        if atomindices==None:
+        if atomindices is None:
             self.coords=allcoords
         else:
             self.coords=allcoords[atomindices]
@@ -151,15 +395,23 @@ class XTCReader:
 
     for c in XTCReader(["part1.xtc","part2.xtc"], firstframe=100, lastframe = 200, stepframe = 2, atomindices = [0,1,2]):
         print c.step
+
+    When atomindices are 0, 1, ..., K-1, the first K atoms are taken as a slice of the decoded frame rather
+    than gathered with fancy indexing (every frame is still decompressed in full).
     """
         
 
 
     def _open(self, filename):
-        """Opens the xtc file with the specified name."""        
+        """Opens the xtc file with the specified name.  If frames are to be skipped, its frame offsets are scanned so that they can be skipped by seeking."""        
         self.xdr = _xdrlib.xdrfile_open(filename, "r")
         if not self.xdr:
             raise IOError("Unable to open xtc file " + str(filename) + ".")
+        self._fileframe = 0
+        if self._seek:
+            self._offsets = xtc_frame_offsets(filename)
+        else:
+            self._offsets = None
 
     def _close(self):
         """Closes currently open xtc file."""
@@ -170,12 +422,18 @@ class XTCReader:
                 self.xdr = None
 
     def __init__(self, filenames, firstframe = 0, lastframe = None, stepframe = 1, atomindices = None, skipcont = True):
+        self._seek = stepframe > 1 or firstframe > 0
         self._firstframe = firstframe
         self._lastframe = lastframe
         self._stepframe = stepframe
         self._nextframe = self._firstframe
-        self._atomindices = atomindices
         self._skipcont = skipcont
+        self._keep = None
+        if atomindices is not None:
+            atomindices = np.asarray(atomindices)
+            if len(atomindices) > 0 and np.array_equal(atomindices, np.arange(len(atomindices))):
+                self._keep, atomindices = len(atomindices), None
+        self._atomindices = atomindices
         
         if isinstance(filenames, str):
             self._filenames = [filenames]
@@ -185,8 +443,13 @@ class XTCReader:
         print(self._filenames)
         self.natoms = number_of_atoms(self._filenames[0])
         self._allcoords = np.empty([self.natoms,3],dtype='single',order='C')
-        if self._atomindices != None:
+        if self._atomindices is not None:
             self._coords = np.empty([len(self._atomindices),3],dtype='single',order='C')
+        if self._keep is not None:
+            if self._keep > self.natoms:
+                raise ValueError("atomindices refer to " + str(self._keep) + " atoms, but the xtc file has only " + str(self.natoms) + ".")
+            if self._keep == self.natoms:
+                self._keep = None
         self._box = np.empty([3,3],dtype='single',order='C')
         self._step = c_int()
         self._time = c_float()
@@ -201,13 +464,27 @@ class XTCReader:
     def __iter__(self):
         return self
 
-    def next(self):
+    def _read_into(self, coords, box):
+        """Decodes frames until the next requested frame has been read into coords (a C-contiguous (natoms,3) float32 array) and box."""
         while self._frame < self._nextframe:
             if self._lastframe != None and self._frame >= self._lastframe:
                 raise StopIteration
-            result = _xdrlib.read_xtc(self.xdr, self.natoms, byref(self._step), byref(self._time), self._box, self._allcoords, byref(self._precision))
+            if self._offsets is not None:
+                # jump over the frames before the next requested one instead of decoding them
+                skip = min(self._nextframe - self._frame - 1, len(self._offsets) - self._fileframe)
+                if skip > 0:
+                    self._frame += skip
+                    self._fileframe += skip
+                    if self._fileframe < len(self._offsets):
+                        _xdr_seek(self.xdr, int(self._offsets[self._fileframe]))
+                    continue
+            if self._offsets is not None and self._fileframe >= len(self._offsets):
+                result = _EXDRENDOFFILE
+            else:
+                result = _xdrlib.read_xtc(self.xdr, self.natoms, byref(self._step), byref(self._time), box, coords, byref(self._precision))
             if result == _EXDROK:
                 self._frame += 1
+                self._fileframe += 1
             elif result == _EXDRENDOFFILE:
                 self._close()
                 if not self._filenames:
@@ -218,12 +495,56 @@ class XTCReader:
                         self._nextframe += 1
             else:
                 raise IOError("An error occured while reading xtc file.")
+        self._nextframe += self._stepframe
+
+    def next(self):
+        self._read_into(self._allcoords, self._box)
 
         # now generate configuration structure that will be returned to caller
+        if self._keep is not None:
+            return Configuration(self._step.value,self._time.value,self._precision.value,self._box,self._allcoords[:self._keep])
         config=Configuration(self._step.value,self._time.value,self._precision.value,self._box,self._allcoords,self._atomindices)
-        self._nextframe += self._stepframe
         return config
 
+    def read_block(self, coords):
+        """Decodes up to len(coords) frames into coords, a caller-supplied (N,natoms,3) float32 array (or (N,len(atomindices),3) if atomindices were given).
+
+        Returns (n, times, steps, boxes), where n is the number of frames read (less than N only at the end
+        of the trajectory) and times, steps and boxes hold the time, step and box of each of those frames.
+        Without atomindices, frames are decoded straight into coords.
+        """
+        if coords.dtype != np.float32 or not coords.flags.c_contiguous:
+            raise TypeError("read_block needs a C-contiguous float32 array.")
+        if self._keep is not None:
+            width = self._keep
+        elif self._atomindices is not None:
+            width = len(self._atomindices)
+        else:
+            width = self.natoms
+        if coords.ndim != 3 or coords.shape[1:] != (width, 3):
+            raise ValueError("read_block needs an array of shape (N," + str(width) + ",3), not " + str(coords.shape) + ".")
+        n = len(coords)
+        times = np.empty(n, dtype='single')
+        steps = np.empty(n, dtype='int32')
+        boxes = np.empty([n,3,3], dtype='single')
+        i = 0
+        try:
+            while i < n:
+                if self._keep is not None:
+                    self._read_into(self._allcoords, boxes[i])
+                    coords[i] = self._allcoords[:self._keep]
+                elif self._atomindices is None:
+                    self._read_into(coords[i], boxes[i])
+                else:
+                    self._read_into(self._allcoords, boxes[i])
+                    coords[i] = self._allcoords[self._atomindices]
+                times[i] = self._time.value
+                steps[i] = self._step.value
+                i += 1
+        except StopIteration:
+            pass
+        return i, times[:i], steps[:i], boxes[:i]
+
 def readxtc(*arg, **karg):
     """Returns a list of coordinates corresponding to the atom positions in an xtc file.
 